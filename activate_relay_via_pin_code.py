@@ -88,9 +88,7 @@ correct_pin = "1234"
 # Activate the relay
 def activate_relay(relay_id):
     if 1 <= relay_id <= 4:
-        lcd.clear()
-        lcd.message("Activate Relay " + str(relay_id) + "\n")
-        lcd.message("Press C to exit")
+        lcd.post("Activate Relay " + str(relay_id) + "\nPress C to exit")
 
         GPIO.output(dict_relay_bcm[relay_id], GPIO.LOW)
 
@@ -112,8 +110,8 @@ def check_pin(key):
 def cleanup():
     global keypad
 
-    lcd.clear()
-    lcd.message("Goodbye...\n")
+    lcd.showScreen("goodbye")
+    lcd.stopRenderer()
     lcd.backlight = False
     keypad.cleanup()
 
@@ -124,9 +122,7 @@ def correct_pin_entered():
 
     entered_pin_is_ok = True
 
-    lcd.clear()
-    lcd.message("Access granted\n")
-    lcd.message("Accepted PIN\n")
+    lcd.showScreen("granted")
 
     print("PIN accepted. Access granted.")
 
@@ -143,18 +139,14 @@ def digit_entered(key):
         entered_pin += str(key)
         print(entered_pin)
 
-        lcd.clear()
-        lcd.message("PIN: " + entered_pin + "\n")
-        lcd.message("# to confirm")
+        lcd.post("PIN: " + entered_pin + "\n# to confirm")
 
         check_pin(key)
 
 
 # Display info on in-corrected PIN code and exit
 def incorrect_pin_entered():
-    lcd.clear()
-    lcd.message("Access denied\n")
-    lcd.message("Incorrect PIN\n")
+    lcd.showScreen("denied")
 
     print("Incorrect PIN. Access denied.")
 
@@ -168,8 +160,16 @@ def initialize_lcd():
     mcp.output(3, 1)  # turn on LCD backlight
     lcd.begin(16, 2)  # set number of LCD lines and columns
 
-    lcd.message("Enter your PIN\n")
-    lcd.message("Press * to clear")
+    # Static screens are compiled once and replayed as raw expander bytes
+    lcd.defineScreen("welcome", "Enter your PIN\nPress * to clear")
+    lcd.defineScreen("granted", "Access granted\nAccepted PIN")
+    lcd.defineScreen("denied", "Access denied\nIncorrect PIN")
+    lcd.defineScreen("goodbye", "Goodbye...")
+    lcd.defineScreen("select_relay", "Digit Relay Id\nto activate")
+
+    lcd.startRenderer()  # draw from a background thread, key handlers never wait for the bus
+
+    lcd.showScreen("welcome")
 
 
 # Initialize the GPIO for the relay module
@@ -189,9 +189,7 @@ def non_digit_entered(key):
     if not entered_pin_is_ok and key == "*" and len(entered_pin) > 0:
         entered_pin = entered_pin[:-1]
 
-        lcd.clear()
-        lcd.message("PIN: " + entered_pin + "\n")
-        lcd.message("# to confirm")
+        lcd.post("PIN: " + entered_pin + "\n# to confirm")
 
         print(entered_pin)
 
@@ -201,9 +199,7 @@ def non_digit_entered(key):
 
 # Display selected relay to activate
 def select_relay_to_activate():
-    lcd.clear()
-    lcd.message("Digit Relay Id\n")
-    lcd.message("to activate")
+    lcd.showScreen("select_relay")
 
     print("Which relay do you want activate/deactivate (1,2,3,4)?")
 
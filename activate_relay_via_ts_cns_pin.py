@@ -40,11 +40,14 @@ __status__ = "Development"
 from pad4pi import rpi_gpio
 from modules.PCF8574 import PCF8574_GPIO
 from modules.Adafruit_LCD1602 import Adafruit_CharLCD
+from modules.PKCS11PinVerifier import PKCS11PinVerifier, PinVerificationError, TokenNotPresent
+from modules.CertificateVerifier import CertificateVerifier, CertificateError, TrustStore, VerificationCache
+from modules.CRLIndex import CRLIndex, CRLIndexError
 
 import RPi.GPIO as GPIO
 import time
 import sys
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 # Check I2C address via command i2cdetect -y 1
 PCF8574_address = 0x27  # I2C address of the PCF8574 chip.
@@ -63,6 +66,32 @@ except:
 # Create LCD, passing in MCP GPIO adapter.
 lcd = Adafruit_CharLCD(pin_rs=0, pin_e=2, pins_db=[4, 5, 6, 7], GPIO=mcp)
 
+# Load the PKCS#11 module once: every PIN check is then a C_Login/C_Logout on the card.
+try:
+    pin_verifier = PKCS11PinVerifier()
+except PinVerificationError as e:
+    print("PKCS#11 Error: ", e)
+    exit(1)
+
+# Load the government CAs once: the card certificate is verified in memory, and a
+# certificate already verified is answered from the cache until the trust store changes.
+try:
+    trust_store = TrustStore()
+except (CertificateError, OSError) as e:
+    print("Trust Store Error: ", e)
+    exit(1)
+
+# Revoked cards are refused through the local CRL index (new CRLs are ingested incrementally).
+try:
+    crl_index = CRLIndex(trust_store=trust_store)
+    crl_index.refresh()
+except (CRLIndexError, OSError) as e:
+    print("CRL Index Error: ", e)
+    exit(1)
+
+certificate_verifier = CertificateVerifier(trust_store, cache=VerificationCache(trust_store, crl_index=crl_index),
+                                           crl_index=crl_index)
+
 KEYPAD = [
     [1, 2, 3, "A"],
     [4, 5, 6, "B"],
@@ -84,13 +113,16 @@ dict_relay_bcm = {
 entered_pin = ""
 entered_pin_is_ok = False
 
+# The card certificate is read and verified in background while the PIN is typed,
+# one check per PIN attempt, tied to the serial of the token it was read from
+certificate_worker = ThreadPoolExecutor(max_workers=1)
+certificate_check = None
+
 
 # Activate the relay
 def activate_relay(relay_id):
     if 1 <= relay_id <= 4:
-        lcd.clear()
-        lcd.message("Activate Relay " + str(relay_id) + "\n")
-        lcd.message("Press C to exit")
+        lcd.post("Activate Relay " + str(relay_id) + "\nPress C to exit")
 
         GPIO.output(dict_relay_bcm[relay_id], GPIO.LOW)
 
@@ -101,33 +133,33 @@ def activate_relay(relay_id):
 def check_pin(key):
     global entered_pin
 
-    command_to_check_pin_cns = "pkcs11-tool --login --test --verbose --pin " + entered_pin
-
     if len(entered_pin) >= 8 or key == "#":
-        lcd.clear()
-        lcd.message("Check PIN CNS...\n")
-
-        p = subprocess.Popen(command_to_check_pin_cns, shell=True, stdout=subprocess.PIPE)
-        (output, err) = p.communicate()
-        p_status = p.wait()
+        lcd.showScreen("check_pin")
 
-        print("Check PIN: ", output)
+        try:
+            (pin_is_ok, pin_serial) = pin_verifier.verify_token(entered_pin)
+        except PinVerificationError as e:
+            print("Check PIN: ", e)
+            pin_is_ok = False
 
-        if p_status == 0:
+        # The relays are enabled only when both the PIN and the certificate are valid, on the same card
+        if not pin_is_ok:
+            incorrect_pin_entered()
+        elif validate_client_certificate(pin_serial):
             correct_pin_entered()
-            if validate_client_certificate():
-                select_relay_to_activate()
         else:
-            incorrect_pin_entered()
+            invalid_certificate()
 
 
 # CleanUp the resources
 def cleanup():
     global keypad
 
-    lcd.clear()
-    lcd.message("Goodbye...\n")
+    lcd.showScreen("goodbye")
+    lcd.stopRenderer()
     lcd.backlight = False
+    certificate_worker.shutdown(wait=False)
+    pin_verifier.close()
 
     keypad.cleanup()
 
@@ -138,15 +170,24 @@ def correct_pin_entered():
 
     entered_pin_is_ok = True
 
-    lcd.clear()
-    lcd.message("Access granted\n")
-    lcd.message("Accepted PIN\n")
+    lcd.showScreen("granted")
 
     print("PIN accepted. Access granted.")
 
     select_relay_to_activate()
 
 
+# Display info on a refused (invalid, revoked or unverifiable) certificate and exit
+def invalid_certificate():
+    lcd.showScreen("denied_cert")
+
+    print("Invalid client certificate. Access denied.")
+
+    time.sleep(5)
+    cleanup()
+    sys.exit()
+
+
 # Construct the entered PIN code
 def digit_entered(key):
     global entered_pin, entered_pin_is_ok
@@ -154,21 +195,19 @@ def digit_entered(key):
     if entered_pin_is_ok:
         activate_relay(key)
     else:
+        start_certificate_check()
+
         entered_pin += str(key)
         print(entered_pin)
 
-        lcd.clear()
-        lcd.message("PIN: " + entered_pin + "\n")
-        lcd.message("# to confirm")
+        lcd.post("PIN: " + entered_pin + "\n# to confirm")
 
         check_pin(key)
 
 
 # Display info on in-corrected PIN code and exit
 def incorrect_pin_entered():
-    lcd.clear()
-    lcd.message("Access denied\n")
-    lcd.message("Incorrect PIN\n")
+    lcd.showScreen("denied")
 
     print("Incorrect PIN. Access denied.")
 
@@ -182,8 +221,21 @@ def initialize_lcd():
     mcp.output(3, 1)  # turn on LCD backlight
     lcd.begin(16, 2)  # set number of LCD lines and columns
 
-    lcd.message("Enter your PIN\n")
-    lcd.message("Press * to clear")
+    # Static screens are compiled once and replayed as raw expander bytes
+    lcd.defineScreen("welcome", "Enter your PIN\nPress * to clear")
+    lcd.defineScreen("granted", "Access granted\nAccepted PIN")
+    lcd.defineScreen("denied", "Access denied\nIncorrect PIN")
+    lcd.defineScreen("denied_cert", "Access denied\nInvalid CNS Cert")
+    lcd.defineScreen("goodbye", "Goodbye...")
+    lcd.defineScreen("check_pin", "Check PIN CNS...")
+    lcd.defineScreen("select_relay", "Digit Relay Id\nto activate")
+    lcd.defineScreen("check_cert", "Check CNS Cert..")
+    lcd.defineScreen("cert_passed", "Check CNS Cert..\nPassed")
+    lcd.defineScreen("cert_failed", "Check CNS Cert..\nFailed")
+
+    lcd.startRenderer()  # draw from a background thread, key handlers never wait for the bus
+
+    lcd.showScreen("welcome")
 
 
 # Initialize the GPIO for the relay module
@@ -203,9 +255,7 @@ def non_digit_entered(key):
     if not entered_pin_is_ok and key == "*" and len(entered_pin) > 0:
         entered_pin = entered_pin[:-1]
 
-        lcd.clear()
-        lcd.message("PIN: " + entered_pin + "\n")
-        lcd.message("# to confirm")
+        lcd.post("PIN: " + entered_pin + "\n# to confirm")
 
         print(entered_pin)
 
@@ -215,9 +265,7 @@ def non_digit_entered(key):
 
 # Display selected relay to activate
 def select_relay_to_activate():
-    lcd.clear()
-    lcd.message("Digit Relay Id\n")
-    lcd.message("to activate")
+    lcd.showScreen("select_relay")
 
     print("Which relay do you want activate/deactivate (1,2,3,4)?")
 
@@ -232,27 +280,60 @@ def key_pressed(key):
         non_digit_entered(key)
 
 
-# Validate the client certificate
-def validate_client_certificate():
-    command_to_validate_certificate = "pkcs15-tool -v -r 01|openssl verify"
-
-    lcd.clear()
-    lcd.message("Check CNS Cert..\n")
-
-    p = subprocess.Popen(command_to_validate_certificate, shell=True, stdout=subprocess.PIPE)
-    (output, err) = p.communicate()
-    p_status = p.wait()
-
-    print("Check Client Certificate: ", output)
-
-    if p_status == 0:
+# Read and verify the client certificate, returns (token_serial, is_valid, message, card_missing)
+def check_client_certificate():
+    try:
+        token_serial = pin_verifier.token_serial()
+        certificate = pin_verifier.read_certificate()
+        if pin_verifier.token_serial() != token_serial:
+            return None, False, "The smart card was replaced while reading the certificate", False
+        result = certificate_verifier.verify(certificate)
+        return token_serial, result.valid, result.reason + " " + str(result.subject), False
+    except TokenNotPresent as e:
+        return None, False, str(e), True
+    except PinVerificationError as e:
+        return None, False, str(e), False
+    except Exception as e:
+        # e.g. a CRLIndexError while reloading the index: the certificate is not accepted
+        return None, False, f"{type(e).__name__}: {e}", False
+
+
+# Start the certificate check in background at the first digit of a PIN attempt
+def start_certificate_check():
+    global certificate_check
+
+    if certificate_check is None:
+        certificate_check = certificate_worker.submit(check_client_certificate)
+
+
+# Validate the client certificate of the card whose PIN was verified (pin_serial)
+def validate_client_certificate(pin_serial):
+    global certificate_check
+
+    lcd.showScreen("check_cert")
+
+    start_certificate_check()
+    (token_serial, is_valid, message, card_missing) = certificate_check.result()
+    certificate_check = None  # the next PIN attempt starts its own check
+
+    if card_missing or token_serial != pin_serial:
+        # The card was inserted or replaced after the check started: check the current one
+        (token_serial, is_valid, message, card_missing) = check_client_certificate()
+        if token_serial != pin_serial:
+            if token_serial is not None:
+                message = "The certificate was not read from the card whose PIN was verified"
+            is_valid = False
+
+    print("Check Client Certificate: ", message)
+
+    if is_valid:
         print("TS-CNS Client Certificate validation passed")
-        lcd.message("Passed")
+        lcd.showScreen("cert_passed")
 
         return True
     else:
         print("TS-CNS Client Certificate validation failed")
-        lcd.message("Failed")
+        lcd.showScreen("cert_failed")
 
         return False
 
@@ -264,6 +345,12 @@ try:
     keypad.registerKeyPressHandler(key_pressed)
 
     initialize_lcd()
+
+    try:
+        pin_verifier.open()  # session ready before the first PIN is typed
+    except PinVerificationError:
+        pass  # no card yet: the session is opened by the first check
+
     initialize_relay()
 
     print("Enter your PIN:")
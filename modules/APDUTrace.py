@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Registrazione e riproduzione offline del traffico APDU verso la smart card.
+
+RecordingConnection avvolge una connessione pyscard e annota ogni scambio (comando,
+risposta, SW1/SW2 e durata); la traccia può essere salvata in un file JSON Lines
+compatto: una prima riga con l'ATR, poi una riga per APDU con i byte in esadecimale.
+
+ReplayConnection serve le risposte di una traccia a get_ts_data (o a qualsiasi funzione
+che usi send_apdu) senza carta né lettore: i comandi devono arrivare nello stesso ordine
+della registrazione. Le tracce possono anche essere costruite a mano con APDUTrace.add(),
+ad esempio per verificare i rami 6Cxx e 67:00 della lettura.
+
+Esempio:
+    connection = RecordingConnection(reader.createConnection())
+    connection.connect()
+    get_ts_data(connection)
+    connection.trace.save('lettura.trace')
+    ...
+    ts_data = get_ts_data(ReplayConnection(APDUTrace.load('lettura.trace')))
+
+Autore: Antonio Musarra <antonio.musarra[at]gmail.com>
+"""
+
+import json
+import time
+
+from modules.TSCNSCard import to_hex_string
+
+
+class APDUTraceMismatch(Exception):
+    """Il comando inviato alla ReplayConnection non è quello registrato."""
+    pass
+
+
+class APDUTrace(object):
+    """Sequenza di scambi APDU registrati: (comando, risposta, sw1, sw2, durata in secondi)."""
+
+    def __init__(self, atr=None, exchanges=None):
+        self.atr = list(atr) if atr is not None else []
+        self.exchanges = list(exchanges) if exchanges is not None else []
+
+    def add(self, command, response, sw1, sw2, duration=0.0):
+        self.exchanges.append((list(command), list(response), sw1, sw2, duration))
+
+    def __len__(self):
+        return len(self.exchanges)
+
+    def save(self, path):
+        with open(path, 'w') as trace_file:
+            trace_file.write(json.dumps({'atr': bytes(self.atr).hex()}, separators=(',', ':')) + '\n')
+            for (command, response, sw1, sw2, duration) in self.exchanges:
+                trace_file.write(json.dumps({
+                    'c': bytes(command).hex(),
+                    'r': bytes(response).hex(),
+                    'sw': f'{sw1:02x}{sw2:02x}',
+                    'us': round(duration * 1e6),
+                }, separators=(',', ':')) + '\n')
+
+    @classmethod
+    def load(cls, path):
+        trace = cls()
+        with open(path) as trace_file:
+            header = json.loads(trace_file.readline())
+            trace.atr = list(bytes.fromhex(header['atr']))
+            for line in trace_file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                sw = bytes.fromhex(entry['sw'])
+                trace.add(bytes.fromhex(entry['c']), bytes.fromhex(entry['r']), sw[0], sw[1], entry.get('us', 0) / 1e6)
+        return trace
+
+    def total_time(self):
+        """Tempo complessivo passato sulla carta durante la registrazione (secondi)."""
+        return sum(exchange[4] for exchange in self.exchanges)
+
+
+class RecordingConnection(object):
+    """Connessione che inoltra gli APDU alla connessione reale e li registra in self.trace."""
+
+    def __init__(self, connection, trace=None):
+        self.connection = connection
+        self.trace = trace if trace is not None else APDUTrace()
+
+    def connect(self, *args, **kwargs):
+        result = self.connection.connect(*args, **kwargs)
+        self.trace.atr = list(self.connection.getATR())
+        return result
+
+    def transmit(self, apdu, *args, **kwargs):
+        start = time.monotonic()
+        response, sw1, sw2 = self.connection.transmit(apdu, *args, **kwargs)
+        self.trace.add(apdu, response, sw1, sw2, time.monotonic() - start)
+        return response, sw1, sw2
+
+    def __getattr__(self, name):
+        # getATR, disconnect, getReader, ... vanno alla connessione reale
+        return getattr(self.connection, name)
+
+
+class ReplayConnection(object):
+    """Connessione senza carta che restituisce, in ordine, le risposte di una traccia.
+
+    Con realtime=True ogni risposta attende la durata registrata, per misurare tempi
+    realistici; altrimenti le risposte sono immediate e la riproduzione è deterministica.
+    """
+
+    def __init__(self, trace, realtime=False):
+        self.trace = trace
+        self.realtime = realtime
+        self.position = 0
+
+    def connect(self, *args, **kwargs):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def getATR(self):
+        return list(self.trace.atr)
+
+    def rewind(self):
+        self.position = 0
+
+    def transmit(self, apdu, *args, **kwargs):
+        if self.position >= len(self.trace.exchanges):
+            raise APDUTraceMismatch(f"Traccia esaurita, APDU non registrato: {to_hex_string(apdu)}")
+        (command, response, sw1, sw2, duration) = self.trace.exchanges[self.position]
+        if list(apdu) != command:
+            raise APDUTraceMismatch(
+                f"APDU {self.position}: atteso {to_hex_string(command)}, ricevuto {to_hex_string(apdu)}")
+        self.position += 1
+        if self.realtime and duration:
+            time.sleep(duration)
+        return list(response), sw1, sw2
+
+    def finished(self):
+        """True se tutti gli APDU registrati sono stati riprodotti."""
+        return self.position == len(self.trace.exchanges)
@@ -1,4 +1,48 @@
-from time import sleep
+import math
+import threading
+from collections import OrderedDict
+from time import sleep, monotonic
+
+
+class LCDTimingProfile(object):
+    """ Minimum HD44780 execution times (microseconds) to respect between commands """
+
+    # datasheet values at fosc = 270kHz
+    WRITE_US = 37
+    CLEAR_US = 1520
+    INIT_US = 4100
+
+    # Raspberry Pi default I2C speed, assumed for an expander when no profile is given
+    DEFAULT_BUS_HZ = 100000
+
+    def __init__(self, write_us=WRITE_US, clear_us=CLEAR_US, init_us=INIT_US, margin=1.5):
+        # margin covers slower oscillators (about 190kHz on cheap modules)
+        self.write_us = write_us * margin
+        self.clear_us = clear_us * margin
+        self.init_us = init_us * margin
+        # time of one port byte on the bus, None when unknown
+        self.byte_us = None
+
+    @classmethod
+    def forBusSpeed(cls, bus_hz, margin=1.5):
+        """ Profile for an I2C expander: the bus already spends two bytes before the next latch """
+        covered_us = 2 * 9 * 1000000.0 / bus_hz  # 8 data bits + ACK per byte
+        return cls.fromCovered(covered_us, margin)
+
+    @classmethod
+    def fromCovered(cls, covered_us, margin=1.5):
+        """ Profile whose delays are reduced by the transfer time that precedes every latch """
+        profile = cls(margin=margin)
+        profile.write_us = max(0.0, profile.write_us - covered_us)
+        profile.clear_us = max(0.0, profile.clear_us - covered_us)
+        profile.byte_us = covered_us / 2
+        return profile
+
+    def delayFor(self, bits, char_mode=False):
+        """ Time the controller needs to execute a byte """
+        if not char_mode and bits in (0x01, 0x02, 0x03):  # clear display, return home
+            return self.clear_us
+        return self.write_us
 
 
 class Adafruit_CharLCD(object):
@@ -45,7 +89,19 @@ class Adafruit_CharLCD(object):
     LCD_5x10DOTS            = 0x04
     LCD_5x8DOTS             = 0x00
 
-    def __init__(self, pin_rs=25, pin_e=24, pins_db=[23, 17, 21, 22], GPIO=None):
+    # 5x8 status icons for glyph()
+    GLYPH_LOCK              = (0x0E, 0x11, 0x11, 0x1F, 0x1B, 0x1B, 0x1F, 0x00)
+    GLYPH_UNLOCK            = (0x0E, 0x10, 0x10, 0x1F, 0x1B, 0x1B, 0x1F, 0x00)
+    GLYPH_RELAY_ON          = (0x04, 0x0E, 0x1F, 0x1F, 0x0E, 0x04, 0x0E, 0x00)
+    GLYPH_SPINNER           = ((0x00, 0x04, 0x04, 0x04, 0x04, 0x04, 0x00, 0x00),
+                               (0x00, 0x01, 0x02, 0x04, 0x08, 0x10, 0x00, 0x00),
+                               (0x00, 0x00, 0x00, 0x1F, 0x00, 0x00, 0x00, 0x00),
+                               (0x00, 0x10, 0x08, 0x04, 0x02, 0x01, 0x00, 0x00))
+    CGRAM_SLOTS             = 8
+    DDRAM_LINE              = 40    # characters per line in DDRAM, visible or not
+    BLOCK_BYTES             = 33    # port bytes per SMBus block write (PCF8574_I2C.BLOCK_SIZE + 1)
+
+    def __init__(self, pin_rs=25, pin_e=24, pins_db=[23, 17, 21, 22], GPIO=None, timing=None):
         # Emulate the old behavior of using RPi.GPIO if we haven't been given
         # an explicit GPIO interface to use
         if not GPIO:
@@ -63,7 +119,30 @@ class Adafruit_CharLCD(object):
         for pin in self.pins_db:
             self.GPIO.setup(pin, GPIO.OUT)
 
+        # An I2C expander (PCF8574_GPIO) can latch a whole port byte per bus
+        # write, so compose RS/E/D4-D7 frames in memory and send them in bulk
+        self.bulk = hasattr(self.GPIO, 'writeBlock')
+        if self.bulk:
+            self.frame_mask = (1 << self.pin_rs) | (1 << self.pin_e)
+            for pin in self.pins_db:
+                self.frame_mask |= 1 << pin
+            self.nibble_bits = []
+            for nibble in range(16):
+                value = 0
+                for i in range(4):
+                    if nibble & (1 << i):
+                        value |= 1 << self.pins_db[i]
+                self.nibble_bits.append(value)
+
+        # Commands are paced by deadlines: each write records when the
+        # controller will be ready and the next one sleeps only for what is left
+        if timing is None:
+            timing = LCDTimingProfile.forBusSpeed(LCDTimingProfile.DEFAULT_BUS_HZ) if self.bulk else LCDTimingProfile()
+        self.timing = timing
+        self.ready_at = 0.0
+
         self.write4bits(0x33)  # initialization
+        self.holdFor(self.timing.init_us)
         self.write4bits(0x32)  # initialization
         self.write4bits(0x28)  # 2 line 5x7 matrix
         self.write4bits(0x0C)  # turn cursor off 0x0E to enable cursor
@@ -78,26 +157,64 @@ class Adafruit_CharLCD(object):
         self.displaymode = self.LCD_ENTRYLEFT | self.LCD_ENTRYSHIFTDECREMENT
         self.write4bits(self.LCD_ENTRYMODESET | self.displaymode)  # set the entry mode
 
+        # In-memory copy of the visible DDRAM, used by render() to write only
+        # the cells that changed. None means the content is unknown.
+        self.numcols = 16
+        self.numlines = 2
+        self.shadow = None
+        self.cursor_col = 0
+        self.cursor_row = 0
+        self.row_offsets = [0x00, 0x40, 0x14, 0x54]
+
+        # Background renderer: post() stores the latest screen and the worker
+        # draws only the newest one, so callers never wait for the bus
+        self.render_cond = threading.Condition()
+        self.renderer = None
+        self.renderer_running = False
+        self.pending = None
+        self.drawing = False
+        self.io_lock = threading.RLock()
+
+        # CGRAM glyph cache: bitmap -> slot, least recently used first
+        self.glyphs = OrderedDict()
+
+        # Static screens precompiled into expander byte streams
+        self.screens = {}
+        self.screen_index = {}
+
+        # Marquee: text loaded once in the 40 character DDRAM lines and
+        # animated by display shift commands from a timer thread
+        self.marquee_thread = None
+        self.marquee_stop = threading.Event()
+
         self.clear()
 
     def begin(self, cols, lines):
         if (lines > 1):
-            self.numlines = lines
             self.displayfunction |= self.LCD_2LINE
+        if (cols, lines) != (self.numcols, self.numlines):
+            self.numcols = cols
+            self.numlines = lines
+            self.shadow = None
 
     def home(self):
-        self.write4bits(self.LCD_RETURNHOME)  # set cursor position to zero
-        self.delayMicroseconds(3000)  # this command takes a long time!
+        self.write4bits(self.LCD_RETURNHOME)  # set cursor position to zero, takes a long time
+        self.cursor_col = 0
+        self.cursor_row = 0
 
     def clear(self):
-        self.write4bits(self.LCD_CLEARDISPLAY)  # command to clear display
-        self.delayMicroseconds(3000)  # 3000 microsecond sleep, clearing the display takes a long time
+        self.write4bits(self.LCD_CLEARDISPLAY)  # command to clear display, takes a long time
+        self.shadow = [[' '] * self.numcols for row in range(self.numlines)]
+        self.cursor_col = 0
+        self.cursor_row = 0
 
     def setCursor(self, col, row):
         self.row_offsets = [0x00, 0x40, 0x14, 0x54]
-        if row > self.numlines:
+        if row >= self.numlines:
             row = self.numlines - 1  # we count rows starting w/0
         self.write4bits(self.LCD_SETDDRAMADDR | (col + self.row_offsets[row]))
+        self.cursor_col = col
+        self.cursor_row = row
 
     def noDisplay(self):
         """ Turn the display off (quickly) """
@@ -159,7 +276,12 @@ class Adafruit_CharLCD(object):
 
     def write4bits(self, bits, char_mode=False):
         """ Send command to LCD """
-        self.delayMicroseconds(1000)  # 1000 microsecond sleep
+        self.waitReady()
+        delay = self.timing.delayFor(bits, char_mode)  # before bits becomes a bit string
+        if self.bulk:
+            self.GPIO.writeBlock(self.frameBytes(bits, char_mode))
+            self.holdFor(delay)
+            return
         bits = bin(bits)[2:].zfill(8)
         self.GPIO.output(self.pin_rs, char_mode)
         for pin in self.pins_db:
@@ -174,26 +296,367 @@ class Adafruit_CharLCD(object):
             if bits[i] == "1":
                 self.GPIO.output(self.pins_db[::-1][i-4], True)
         self.pulseEnable()
+        self.holdFor(delay)
 
     def delayMicroseconds(self, microseconds):
         seconds = microseconds / float(1000000)  # divide microseconds by 1 million for seconds
         sleep(seconds)
 
+    def holdFor(self, microseconds):
+        """ Mark the controller busy for at least microseconds from now """
+        self.ready_at = max(self.ready_at, monotonic() + microseconds / 1000000.0)
+
+    def waitReady(self):
+        """ Sleep only for the part of the last command execution time still missing """
+        remaining = self.ready_at - monotonic()
+        if remaining > 0:
+            sleep(remaining)
+
     def pulseEnable(self):
+        # a GPIO call already outlasts the 450ns enable pulse width, and the
+        # command settle time is tracked by the ready_at deadline
         self.GPIO.output(self.pin_e, False)
-        self.delayMicroseconds(1)       # 1 microsecond pause - enable pulse must be > 450ns
         self.GPIO.output(self.pin_e, True)
-        self.delayMicroseconds(1)       # 1 microsecond pause - enable pulse must be > 450ns
         self.GPIO.output(self.pin_e, False)
-        self.delayMicroseconds(1)       # commands need > 37us to settle
+
+    def calibrateTiming(self, samples=32, margin=1.5):
+        """ Measure the time a command takes on the wire and adopt the matching timing profile """
+        command = self.LCD_DISPLAYCONTROL | self.displaycontrol  # harmless to repeat
+        self.timing = LCDTimingProfile(write_us=0, clear_us=0, init_us=0)
+        self.waitReady()
+        start = monotonic()
+        for i in range(samples):
+            self.write4bits(command)
+        elapsed_us = (monotonic() - start) * 1000000.0 / samples
+        # the next command is latched halfway through its own transfer
+        self.timing = LCDTimingProfile.fromCovered(elapsed_us / 2, margin)
+        return self.timing
+
+    def frameBytes(self, bits, char_mode=False, port=None):
+        """ Compose the expander bytes that clock one byte into the LCD """
+        if port is None:
+            port = self.GPIO.outputByte()
+        base = port & ~self.frame_mask
+        if char_mode:
+            base |= 1 << self.pin_rs
+        enable = 1 << self.pin_e
+        high = base | self.nibble_bits[(bits >> 4) & 0x0F]
+        low = base | self.nibble_bits[bits & 0x0F]
+        # data is latched on the falling edge of E
+        return [high | enable, high, low | enable, low]
+
+    def idleBytes(self, bits, char_mode=False):
+        """ Port bytes to repeat after a frame so that the bus time covers the
+            execution time of the byte; None when the bus speed is unknown """
+        delay = self.timing.delayFor(bits, char_mode)
+        if delay <= 0:
+            return 0
+        if not self.timing.byte_us:
+            return None
+        return int(math.ceil(delay / self.timing.byte_us))
+
+    def streamBytes(self, items, port=None):
+        """ Expander bytes clocking (bits, char_mode) items back to back, padded with idle
+            port bytes between them; None if the padding cannot be computed """
+        if port is None:
+            port = self.GPIO.outputByte()
+        frames = []
+        idle = 0
+        for bits, char_mode in items:
+            if frames:
+                frames += frames[-1:] * idle  # the port keeps its value: nothing is latched
+            frames += self.frameBytes(bits, char_mode, port)
+            idle = self.idleBytes(bits, char_mode)
+            if idle is None:
+                return None
+        return frames
+
+    def trackChar(self, char):
+        """ Record a character written at the cursor in the shadow DDRAM """
+        if char == '\n':
+            self.cursor_col = 0
+            self.cursor_row = 1
+            return
+        if (self.shadow is not None and self.cursor_row < self.numlines
+                and 0 <= self.cursor_col < self.numcols):
+            self.shadow[self.cursor_row][self.cursor_col] = char
+        if self.displaymode & self.LCD_ENTRYLEFT:
+            self.cursor_col += 1
+        else:
+            self.cursor_col -= 1
 
     def message(self, text):
         """ Send string to LCD. Newline wraps to second line"""
-        for char in text:
-            if char == '\n':
-                self.write4bits(0xC0)  # next line
+        items = [(0xC0, False) if char == '\n' else (ord(char), True) for char in text]  # 0xC0: next line
+        frames = self.streamBytes(items) if self.bulk and items else None
+        if frames is not None:
+            # the whole text goes out back to back, the idle bytes between the
+            # characters give the HD44780 the time it needs for each of them
+            self.waitReady()
+            try:
+                self.GPIO.writeBlock(frames)
+            except Exception:
+                # part of the text may have reached the display: the next render() redraws it all
+                self.shadow = None
+                raise
+            self.holdFor(self.timing.write_us)
+            # only what actually reached the display goes into the shadow DDRAM
+            for char in text:
+                self.trackChar(char)
+            return
+        for char, (bits, char_mode) in zip(text, items):
+            self.write4bits(bits, char_mode)
+            self.trackChar(char)
+
+    def render(self, lines):
+        """ Show lines (list or newline separated string) writing only the changed cells """
+        self.stopMarquee()
+        with self.io_lock:
+            rows = self.screenRows(lines)
+            if self.shadow is None:
+                self.shadow = [[None] * self.numcols for row in range(self.numlines)]
+            runs = self.diffRuns(rows)
+            screen = self.screen_index.get(rows)
+            # a registered screen is replayed only when that takes fewer transfers than the diff
+            if (runs and screen is not None and self.bulk and self.screenFrames(screen) is not None
+                    and self.transfers(len(screen['frames'])) < self.diffTransfers(runs)):
+                self.replay(screen)
+                return
+            for row, col, end in runs:
+                self.setCursor(col, row)
+                self.message(rows[row][col:end])
+
+    def diffRuns(self, rows):
+        """ (row, start, end) runs of cells that differ from the shadow DDRAM """
+        runs = []
+        for row in range(self.numlines):
+            text = rows[row]
+            current = self.shadow[row]
+            col = 0
+            while col < self.numcols:
+                if current[col] == text[col]:
+                    col += 1
+                    continue
+                # extend the run across single unchanged cells: rewriting one
+                # cell costs no more than the setCursor needed to skip it
+                end = col + 1
+                while end < self.numcols and (current[end] != text[end] or
+                                              (end + 1 < self.numcols and current[end + 1] != text[end + 1])):
+                    end += 1
+                runs.append((row, col, end))
+                col = end
+        return runs
+
+    def transfers(self, byte_count):
+        return int(math.ceil(byte_count / float(self.BLOCK_BYTES)))
+
+    def diffTransfers(self, runs):
+        """ Bus transfers of the diff path: a setCursor and a message() per run """
+        char_bytes = 4 + (self.idleBytes(ord(' '), True) or 0)
+        return sum(1 + self.transfers(char_bytes * (end - col)) for row, col, end in runs)
+
+    def screenRows(self, lines):
+        """ Lines (list or newline separated string) padded to the display size """
+        if isinstance(lines, str):
+            lines = lines.split('\n')
+        rows = []
+        for row in range(self.numlines):
+            text = lines[row] if row < len(lines) else ''
+            rows.append(text[:self.numcols].ljust(self.numcols))
+        return tuple(rows)
+
+    def defineScreen(self, name, lines, compile=False):
+        """ Register a static screen: it is compiled once into the expander byte
+            stream and replayed verbatim by showScreen() or by render() of the same text """
+        rows = self.screenRows(lines)
+        screen = {'name': name, 'rows': rows, 'cells': [list(text) for text in rows],
+                  'base': None, 'frames': None}
+        self.screens[name] = screen
+        self.screen_index[rows] = screen
+        if compile and self.bulk:
+            self.compileScreen(screen)
+        return screen
+
+    def timingKey(self):
+        return (self.timing.byte_us, self.timing.write_us)
+
+    def compileScreen(self, screen):
+        port = self.GPIO.outputByte()
+        items = []
+        for row, text in enumerate(screen['rows']):
+            items.append((self.LCD_SETDDRAMADDR | self.row_offsets[row], False))
+            items += [(ord(char), True) for char in text]
+        screen['base'] = port & ~self.frame_mask
+        screen['timing'] = self.timingKey()
+        screen['frames'] = self.streamBytes(items, port)  # None: cannot be replayed
+
+    def showScreen(self, name):
+        """ Show a screen registered with defineScreen(), through the renderer when it runs """
+        self.post(self.screens[name]['rows'])
+
+    def screenFrames(self, screen):
+        """ Compiled stream of a screen, None if it cannot be replayed with the current timing """
+        # the stream embeds the other port bits (backlight) and the idle padding of
+        # the timing profile: recompile if either changed
+        if (screen['base'] != self.GPIO.outputByte() & ~self.frame_mask
+                or screen.get('timing') != self.timingKey()):
+            self.compileScreen(screen)
+        return screen['frames']
+
+    def replay(self, screen):
+        """ Send the compiled stream of a screen; False if it has no stream for the current timing """
+        if self.shadow == screen['cells']:
+            return True  # already on the display
+        if self.screenFrames(screen) is None:
+            return False
+        self.waitReady()
+        self.GPIO.writeBlock(screen['frames'])
+        self.holdFor(self.timing.write_us)
+        self.shadow = [list(row) for row in screen['cells']]
+        self.cursor_col = self.numcols
+        self.cursor_row = self.numlines - 1
+        return True
+
+    def writeSequence(self, items):
+        """ Send (bits, char_mode) pairs, in a single bulk transfer when possible """
+        frames = self.streamBytes(items) if self.bulk and items else None
+        if frames is None:
+            for bits, char_mode in items:
+                self.write4bits(bits, char_mode)
+            return
+        self.waitReady()
+        self.GPIO.writeBlock(frames)
+        self.holdFor(self.timing.delayFor(*items[-1]))
+
+    def glyph(self, bitmap):
+        """ Return the character showing a 5x8 bitmap, uploading it to CGRAM only when not resident """
+        key = tuple(row & 0x1F for row in bitmap)
+        if len(key) != 8:
+            raise ValueError("A glyph needs 8 rows, got %d" % len(key))
+        with self.io_lock:
+            if key in self.glyphs:
+                self.glyphs.move_to_end(key)
+                return chr(self.glyphs[key])
+            if len(self.glyphs) < self.CGRAM_SLOTS:
+                slot = len(self.glyphs)
             else:
-                self.write4bits(ord(char), True)
+                # evict the least recently used glyph, sparing the ones on screen
+                visible = set()
+                for row in self.shadow or []:
+                    visible.update(row)
+                victim = next(iter(self.glyphs))
+                for resident, resident_slot in self.glyphs.items():
+                    if chr(resident_slot) not in visible:
+                        victim = resident
+                        break
+                slot = self.glyphs.pop(victim)
+                # cells showing the old glyph change too: let render() rewrite them
+                for row in self.shadow or []:
+                    for col, char in enumerate(row):
+                        if char == chr(slot):
+                            row[col] = None
+            items = [(self.LCD_SETCGRAMADDR | (slot << 3), False)]
+            items += [(row, True) for row in key]
+            # go back to DDRAM, otherwise the next character lands in CGRAM
+            row = min(self.cursor_row, self.numlines - 1)
+            items.append((self.LCD_SETDDRAMADDR | (max(self.cursor_col, 0) + self.row_offsets[row]), False))
+            self.writeSequence(items)
+            self.glyphs[key] = slot
+            return chr(slot)
+
+    def marquee(self, lines, interval=0.4):
+        """ Scroll lines longer than the display by shifting it, one command byte per frame.
+            Each line holds up to 40 characters; the display shift moves all lines together. """
+        if isinstance(lines, str):
+            lines = lines.split('\n')
+        if max(len(line) for line in lines) <= self.numcols:
+            self.render(lines)
+            return
+        self.stopMarquee()
+        with self.io_lock:
+            for row in range(self.numlines):
+                text = lines[row] if row < len(lines) else ''
+                self.setCursor(0, row)
+                self.message(text[:self.DDRAM_LINE].ljust(self.DDRAM_LINE))
+            # what is visible now depends on the shift: the next render() rewrites it all
+            self.shadow = None
+        self.marquee_stop.clear()
+        self.marquee_thread = threading.Thread(target=self.marqueeLoop, args=(interval,), name='lcd-marquee')
+        self.marquee_thread.daemon = True
+        self.marquee_thread.start()
+
+    def marqueeLoop(self, interval):
+        while not self.marquee_stop.wait(interval):
+            with self.io_lock:
+                self.DisplayLeft()
+
+    def stopMarquee(self):
+        """ Stop scrolling and bring the display shift back to zero """
+        if self.marquee_thread is None:
+            return
+        self.marquee_stop.set()
+        if self.marquee_thread is not threading.current_thread():
+            self.marquee_thread.join()
+        self.marquee_thread = None
+        with self.io_lock:
+            self.home()  # also resets the display shift
+
+    def startRenderer(self):
+        """ Draw the screens given to post() from a background thread """
+        if self.renderer is not None:
+            return
+        self.renderer_running = True
+        self.renderer = threading.Thread(target=self.renderLoop, name='lcd-render')
+        self.renderer.daemon = True
+        self.renderer.start()
+
+    def stopRenderer(self):
+        """ Draw the last posted screen and stop the background thread """
+        if self.renderer is None:
+            return
+        with self.render_cond:
+            self.renderer_running = False
+            self.render_cond.notify_all()
+        if self.renderer is not threading.current_thread():
+            self.renderer.join()
+        self.renderer = None
+
+    def post(self, lines):
+        """ Ask for lines to be shown and return at once, replacing any screen not drawn yet.
+            While the renderer runs, other threads should not write to the LCD directly. """
+        if self.renderer is None:
+            self.render(lines)
+            return
+        with self.render_cond:
+            self.pending = lines
+            self.render_cond.notify_all()
+
+    def flush(self, timeout=None):
+        """ Wait until the last posted screen is on the display """
+        with self.render_cond:
+            return self.render_cond.wait_for(lambda: self.pending is None and not self.drawing, timeout)
+
+    def renderLoop(self):
+        while True:
+            with self.render_cond:
+                while self.pending is None and self.renderer_running:
+                    self.render_cond.wait()
+                if self.pending is None:
+                    break
+                lines, self.pending = self.pending, None
+                self.drawing = True
+            try:
+                self.render(lines)
+            except Exception as e:
+                # a transient bus error (e.g. errno 121 on the Pi I2C) must not stop
+                # the renderer: the display content is unknown, redraw it all next time
+                print("LCD render error:", e)
+                with self.io_lock:
+                    self.shadow = None
+            finally:
+                with self.render_cond:
+                    self.drawing = False
+                    self.render_cond.notify_all()
 
 
 if __name__ == '__main__':
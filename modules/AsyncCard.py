@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+API asyncio per le operazioni sulla smart card.
+
+Le chiamate pyscard sono bloccanti: AsyncCardService le esegue su un executor dedicato,
+così un'applicazione asyncio (ad esempio la TUI prompt_toolkit di manage_relay_tui.py)
+può attendere la lettura della carta senza bloccare il proprio event loop. Ogni chiamata
+accetta un timeout; alla cancellazione (o allo scadere del timeout) la coroutine termina
+subito, mentre un APDU già in corso sul lettore viene comunque completato dal worker.
+
+Gli inserimenti e le rimozioni delle carte sono disponibili come iteratore asincrono:
+
+    async with AsyncCardService() as cards:
+        ts_data = await cards.read_ts_data(timeout=5)
+        async for event in cards.events():
+            print(event.kind, event.reader)
+
+Autore: Antonio Musarra <antonio.musarra[at]gmail.com>
+"""
+
+import asyncio
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from smartcard.CardMonitoring import CardMonitor, CardObserver
+
+from modules.TSCNSCard import debug_msg
+from modules.CardSession import CardSessionManager
+
+# kind: 'inserted' o 'removed'; atr come lista di byte
+CardEvent = namedtuple('CardEvent', ['kind', 'reader', 'atr'])
+
+
+class AsyncCardService(CardObserver):
+    """Wrapper asyncio di CardSessionManager con executor dedicato ed eventi delle carte."""
+
+    def __init__(self, sessions=None, max_workers=1, timeout=None):
+        # Un solo worker per default: le chiamate PC/SC restano serializzate su un thread
+        self.sessions = sessions if sessions is not None else CardSessionManager(monitor=False)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pcsc')
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.present = {}       # lettore -> CardEvent dell'ultima carta inserita
+        self.subscribers = []   # code asyncio che ricevono gli eventi
+        self.loop = None
+        self.monitor = None
+
+    def start(self):
+        """Avvia il monitoraggio delle carte; va chiamato dall'interno dell'event loop."""
+        self.loop = asyncio.get_running_loop()
+        self.monitor = CardMonitor()
+        self.monitor.addObserver(self)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
+
+    async def run(self, function, *args, timeout=None):
+        """Esegue una chiamata bloccante sull'executor, con timeout in secondi (None: quello del servizio)."""
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, function, *args)
+        return await asyncio.wait_for(future, timeout if timeout is not None else self.timeout)
+
+    async def read_ts_data(self, reader=None, timeout=None):
+        """Legge i dati personali della TS-CNS (come CardSessionManager.read_personal_data)."""
+        return await self.run(self.sessions.read_personal_data, reader, timeout=timeout)
+
+    async def transmit(self, apdu, reader=None, timeout=None):
+        """Invia un APDU e restituisce (response, sw1, sw2)."""
+        return await self.run(self.sessions.transmit, apdu, reader, timeout=timeout)
+
+    async def get_atr(self, reader=None, timeout=None):
+        return await self.run(self.sessions.get_atr, reader, timeout=timeout)
+
+    async def wait_for_card(self, reader=None, timeout=None):
+        """Attende che una carta sia presente (nel lettore indicato o in uno qualsiasi) e
+        restituisce il suo CardEvent; se la carta è già inserita ritorna subito."""
+        if reader is not None:
+            reader = str(reader)
+        queue = self.subscribe()
+        try:
+            with self.lock:
+                for name, event in self.present.items():
+                    if reader is None or name == reader:
+                        return event
+
+            async def next_insertion():
+                while True:
+                    event = await queue.get()
+                    if event.kind == 'inserted' and (reader is None or event.reader == reader):
+                        return event
+
+            return await asyncio.wait_for(next_insertion(), timeout if timeout is not None else self.timeout)
+        finally:
+            self.unsubscribe(queue)
+
+    async def events(self):
+        """Iteratore asincrono dei CardEvent di inserimento e rimozione."""
+        queue = self.subscribe()
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.unsubscribe(queue)
+
+    def subscribe(self):
+        queue = asyncio.Queue()
+        with self.lock:
+            self.subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            if queue in self.subscribers:
+                self.subscribers.remove(queue)
+
+    def update(self, observable, actions):
+        """Notifica del CardMonitor (thread del monitor): aggiorna le carte presenti e inoltra
+        gli eventi all'event loop."""
+        (added_cards, removed_cards) = actions
+        # Le connessioni delle carte rimosse vanno chiuse
+        self.sessions.update(observable, actions)
+        events = [CardEvent('removed', str(card.reader), list(card.atr)) for card in removed_cards] + \
+                 [CardEvent('inserted', str(card.reader), list(card.atr)) for card in added_cards]
+        with self.lock:
+            for event in events:
+                debug_msg(f"Evento carta: {event.kind} su {event.reader}")
+                if event.kind == 'inserted':
+                    self.present[event.reader] = event
+                else:
+                    self.present.pop(event.reader, None)
+            subscribers = list(self.subscribers)
+        if self.loop is not None and not self.loop.is_closed():
+            for queue in subscribers:
+                for event in events:
+                    self.loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    async def close(self):
+        """Ferma il monitoraggio, chiude le connessioni e l'executor."""
+        if self.monitor is not None:
+            self.monitor.deleteObserver(self)
+            self.monitor = None
+        await self.run(self.sessions.close)
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,323 @@
+########################################################################
+# Filename    : CRLIndex.py
+# Description : Memory-mapped revocation index built from local CRL files
+########################################################################
+try:
+    from cryptography import x509
+except ImportError:  # pip install cryptography
+    x509 = None
+from datetime import timezone
+from modules.CertificateVerifier import GOV_CERTIFICATES_PATH, CertificateError, TrustStore
+import argparse
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+# CRLs to ingest (e.g. downloaded from the CRL distribution points of the government CAs)
+CRL_PATH = '/usr/local/share/crl'
+INDEX_PATH = '/var/cache/ts-cns-crl'
+CRL_EXTENSIONS = ('.crl', '.pem', '.der')
+PEM_CRL = re.compile(rb'-----BEGIN X509 CRL-----.+?-----END X509 CRL-----', re.DOTALL)
+
+# Index file: magic, number of records, then sorted fixed-size records issuer key + serial key
+MAGIC = b'CRLIDX1\0'
+HEADER = struct.Struct('>8sQ')
+ISSUER_KEY_SIZE = 8
+SERIAL_KEY_SIZE = 20
+RECORD_SIZE = ISSUER_KEY_SIZE + SERIAL_KEY_SIZE
+
+
+class CRLIndexError(Exception):
+    pass
+
+
+def issuer_key(issuer):
+    """ 8 byte key of an issuer Name (or of its DER encoding) """
+    if not isinstance(issuer, bytes):
+        issuer = issuer.public_bytes()
+    return hashlib.sha256(issuer).digest()[:ISSUER_KEY_SIZE]
+
+
+def serial_key(serial):
+    """ Serial numbers are at most 20 octets (RFC 5280); longer and negative ones are hashed """
+    if serial < 0:
+        # Not allowed by RFC 5280 but parsed by cryptography: hash the two's complement encoding
+        data = b'-' + serial.to_bytes(serial.bit_length() // 8 + 1, 'big', signed=True)
+        return hashlib.sha256(data).digest()[:SERIAL_KEY_SIZE]
+    length = (serial.bit_length() + 7) // 8 or 1
+    if length <= SERIAL_KEY_SIZE:
+        return serial.to_bytes(SERIAL_KEY_SIZE, 'big')
+    return hashlib.sha256(serial.to_bytes(length, 'big')).digest()[:SERIAL_KEY_SIZE]
+
+
+def next_update(crl):
+    """ nextUpdate of the CRL as a POSIX timestamp, None if the CRL does not declare it """
+    if hasattr(crl, 'next_update_utc'):
+        value = crl.next_update_utc
+    else:
+        value = crl.next_update and crl.next_update.replace(tzinfo=timezone.utc)
+    return value.timestamp() if value is not None else None
+
+
+def load_crls(filename):
+    with open(filename, 'rb') as crl_file:
+        data = crl_file.read()
+    blocks = PEM_CRL.findall(data)
+    if blocks:
+        return [x509.load_pem_x509_crl(block) for block in blocks]
+    return [x509.load_der_x509_crl(data)]
+
+
+class CRLIndex(object):
+    """ Revoked serial numbers by issuer, in a sorted file of fixed-size records.
+
+        refresh() parses only the CRL files that are new or changed since the last run (each
+        one is kept as a sorted part file) and merges the parts into the index, which is
+        replaced atomically. Lookups binary-search the memory-mapped index, so they cost
+        O(log n) page reads and the index pages are shared by every process using it.
+        The manifest records, for every CRL file, whether its signature was verified and the
+        nextUpdate of each issuer, so is_stale() tells when the revocation data is out of date. """
+
+    def __init__(self, index_path=INDEX_PATH, crl_path=CRL_PATH, trust_store=None, refresh_interval=5.0):
+        if x509 is None:
+            raise CRLIndexError("cryptography is not installed (pip install cryptography)")
+        self.index_path = index_path
+        self.crl_path = crl_path
+        # With a TrustStore, only CRLs signed by one of its CAs are ingested
+        self.trust_store = trust_store
+        self.lock = threading.Lock()
+        self.map = None
+        self.count = 0
+        self.next_updates = {}  # issuer key -> latest nextUpdate (None: no expiry declared)
+        self.generation = None
+        # The lookups map the index again, if replaced, at most every refresh_interval seconds
+        self.refresh_interval = refresh_interval
+        self.next_check = 0.0
+
+    def index_file(self):
+        return os.path.join(self.index_path, 'revoked.idx')
+
+    def manifest_file(self):
+        return os.path.join(self.index_path, 'manifest.json')
+
+    def crl_files(self):
+        if not os.path.isdir(self.crl_path):
+            return []
+        return sorted(name for name in os.listdir(self.crl_path) if name.lower().endswith(CRL_EXTENSIONS))
+
+    def signed_by_trusted_ca(self, crl):
+        if self.trust_store is None:
+            return True
+        with self.trust_store.lock:
+            issuers = self.trust_store.by_subject.get(crl.issuer.public_bytes(), [])
+        return any(crl.is_signature_valid(issuer.public_key()) for issuer in issuers)
+
+    def write_atomic(self, filename, data):
+        temporary = f"{filename}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as output:
+            output.write(data)
+        os.replace(temporary, filename)
+
+    def ingest(self, name):
+        """ Parse one CRL file into a sorted part file; returns its manifest entry (without signature) """
+        records = set()
+        next_updates = {}
+        for crl in load_crls(os.path.join(self.crl_path, name)):
+            if not self.signed_by_trusted_ca(crl):
+                raise CRLIndexError(f"{name}: CRL not signed by a trusted CA")
+            key = issuer_key(crl.issuer)
+            next_updates[key.hex()] = next_update(crl)
+            for revoked in crl:
+                records.add(key + serial_key(revoked.serial_number))
+        self.write_atomic(os.path.join(self.index_path, 'parts', name + '.rec'), b''.join(sorted(records)))
+        return {'revoked': len(records), 'verified': self.trust_store is not None, 'next_update': next_updates}
+
+    def up_to_date(self, entry, signature):
+        """ A manifest entry is reused if its file is unchanged and, with a TrustStore, its signature was checked """
+        return entry.get('signature') == signature and 'next_update' in entry and \
+            (entry.get('verified') or self.trust_store is None)
+
+    def refresh(self):
+        """ Bring the index up to date with the CRL directory; returns the names of the parsed files """
+        os.makedirs(os.path.join(self.index_path, 'parts'), exist_ok=True)
+        try:
+            with open(self.manifest_file()) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            manifest = {}
+
+        parsed = []
+        current = {}
+        for name in self.crl_files():
+            stat = os.stat(os.path.join(self.crl_path, name))
+            signature = [stat.st_size, stat.st_mtime_ns]
+            if self.up_to_date(manifest.get(name, {}), signature):
+                current[name] = manifest[name]
+                continue
+            try:
+                current[name] = dict(self.ingest(name), signature=signature)
+            except (ValueError, CRLIndexError) as e:
+                print(f"CRL skipped: {e}")
+                continue
+            parsed.append(name)
+
+        removed = set(manifest) - set(current)
+        for name in removed:
+            try:
+                os.remove(os.path.join(self.index_path, 'parts', name + '.rec'))
+            except OSError:
+                pass
+
+        if parsed or removed or not os.path.exists(self.index_file()):
+            self.merge(current)
+            self.write_atomic(self.manifest_file(), json.dumps(current, indent=1).encode())
+        self.open()
+        self.warn(current)
+        return parsed
+
+    def warn(self, manifest):
+        """ Report an index that cannot refuse anything, and the CRLs past their nextUpdate """
+        if not manifest:
+            print(f"CRL index is empty: no CRL in {self.crl_path}, revoked certificates are not detected")
+        now = time.time()
+        for name, entry in sorted(manifest.items()):
+            if any(expiry is not None and expiry < now for expiry in entry['next_update'].values()):
+                print(f"CRL expired: {name}, download a newer one (certificates of its CA are refused meanwhile)")
+
+    def merge(self, manifest):
+        """ Merge the sorted part files into the index, dropping duplicates """
+        def records(name):
+            try:
+                with open(os.path.join(self.index_path, 'parts', name + '.rec'), 'rb') as part:
+                    data = part.read()
+            except OSError:
+                data = b''  # part removed by hand: refreshed on the next change of its CRL
+            return (data[i:i + RECORD_SIZE] for i in range(0, len(data), RECORD_SIZE))
+
+        merged = bytearray()
+        previous = None
+        for record in heapq.merge(*(records(name) for name in manifest)):
+            if record != previous:
+                merged += record
+                previous = record
+        self.write_atomic(self.index_file(), HEADER.pack(MAGIC, len(merged) // RECORD_SIZE) + merged)
+
+    def read_next_updates(self):
+        """ Latest nextUpdate of every issuer listed in the manifest """
+        try:
+            with open(self.manifest_file()) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return {}
+        next_updates = {}
+        for entry in manifest.values():
+            for key, expiry in entry.get('next_update', {}).items():
+                key = bytes.fromhex(key)
+                if key not in next_updates:
+                    next_updates[key] = expiry
+                elif next_updates[key] is not None:
+                    # The newest CRL of the issuer counts; None means it declares no expiry
+                    next_updates[key] = None if expiry is None else max(expiry, next_updates[key])
+        return next_updates
+
+    def open(self):
+        """ Map the index file again if it (or the manifest) was replaced, by this or another process """
+        try:
+            stat = os.stat(self.index_file())
+            manifest_stat = os.stat(self.manifest_file())
+        except OSError:
+            return False
+        generation = (stat.st_ino, stat.st_mtime_ns, manifest_stat.st_ino, manifest_stat.st_mtime_ns)
+        with self.lock:
+            if generation == self.generation:
+                return False
+            with open(self.index_file(), 'rb') as index_file:
+                mapped = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, count = HEADER.unpack_from(mapped)
+            if magic != MAGIC or len(mapped) != HEADER.size + count * RECORD_SIZE:
+                mapped.close()
+                raise CRLIndexError(f"Invalid index file {self.index_file()}")
+            if self.map is not None:
+                self.map.close()
+            self.map, self.count, self.generation = mapped, count, generation
+            self.next_updates = self.read_next_updates()
+        return True
+
+    def reload(self):
+        """ open() at most every refresh_interval seconds, so the lookups see an index refreshed by cron """
+        now = time.monotonic()
+        with self.lock:
+            if now < self.next_check:
+                return False
+            self.next_check = now + self.refresh_interval
+        return self.open()
+
+    def __len__(self):
+        return self.count
+
+    def is_revoked(self, certificate):
+        """ True if the serial number of certificate is listed by a CRL of its issuer """
+        self.reload()
+        return self.lookup(issuer_key(certificate.issuer) + serial_key(certificate.serial_number))
+
+    def is_stale(self, certificate, now=None):
+        """ True if the CRL of the certificate issuer is past its nextUpdate: the index may miss
+            revocations published since, so the certificate cannot be accepted """
+        now = time.time() if now is None else now
+        self.reload()
+        with self.lock:
+            expiry = self.next_updates.get(issuer_key(certificate.issuer))
+        return expiry is not None and expiry < now
+
+    def earliest_next_update(self):
+        """ Earliest nextUpdate among the issuers, None if no CRL declares one """
+        with self.lock:
+            expiries = [expiry for expiry in self.next_updates.values() if expiry is not None]
+        return min(expiries) if expiries else None
+
+    def lookup(self, record):
+        with self.lock:
+            if self.map is None:
+                return False
+            low, high = 0, self.count
+            while low < high:
+                middle = (low + high) // 2
+                start = HEADER.size + middle * RECORD_SIZE
+                if self.map[start:start + RECORD_SIZE] < record:
+                    low = middle + 1
+                else:
+                    high = middle
+            start = HEADER.size + low * RECORD_SIZE
+            return low < self.count and self.map[start:start + RECORD_SIZE] == record
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+                self.generation = None
+
+
+if __name__ == '__main__':
+    # Refresh the index, e.g. from cron after downloading new CRLs:
+    #   python3 -m modules.CRLIndex --crl-path /usr/local/share/crl
+    parser = argparse.ArgumentParser(description='Update the revocation index from a CRL directory.')
+    parser.add_argument('--crl-path', default=CRL_PATH, help='Directory of the CRL files')
+    parser.add_argument('--index-path', default=INDEX_PATH, help='Directory of the index')
+    parser.add_argument('--ca-path', default=GOV_CERTIFICATES_PATH,
+                        help='Trusted CAs: only CRLs signed by one of them are ingested')
+    args = parser.parse_args()
+
+    try:
+        trust_store = TrustStore(args.ca_path)
+    except (CertificateError, OSError) as e:
+        parser.exit(1, f"Trust Store Error: {e}\n")
+    index = CRLIndex(args.index_path, args.crl_path, trust_store=trust_store)
+    parsed = index.refresh()
+    print(f"Parsed {len(parsed)} CRL files, {len(index)} revoked certificates in the index")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cache dei dati personali letti dalla TS-CNS, indicizzata per ATR e identificativo della carta.
+
+Prima di ogni lettura viene letto l'EF ID_Carta (3F00/1000/1003), che contiene il numero
+di serie della carta: se per la coppia (ATR, ID carta) esiste un record valido, viene
+restituito senza rileggere l'EF dei dati personali. Finché l'EF ID_Carta resta selezionato
+sulla connessione, il controllo dell'identità costa un solo READ BINARY.
+
+Lo stato di selezione e la chiave della carta letta sono annotati sulla connessione:
+chi invia altri APDU sulla stessa connessione deve chiamare forget_selection(). Le voci
+scadono dopo un TTL, il numero di voci è limitato (eviction LRU) e la chiusura della
+connessione (ad esempio alla rimozione della carta) invalida solo la voce della carta
+letta su quella connessione.
+
+Autore: Antonio Musarra <antonio.musarra[at]gmail.com>
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from modules.TSCNSCard import CardStatusError, debug_msg, execute_apdu, get_ts_data, select_path, PATH_EF_ID_CARTA
+
+READ_BIN = [0x00, 0xB0, 0x00, 0x00, 0x00]
+
+# Attributi annotati sulla connessione: Le della lettura dell'EF ID_Carta se selezionato, chiave della carta
+ID_CARTA_LE = 'ts_cns_id_carta_le'
+CARD_KEY = 'ts_cns_card_key'
+
+
+def forget_selection(connection):
+    """Da chiamare dopo aver selezionato altri file sulla connessione: l'EF ID_Carta andrà riselezionato."""
+    setattr(connection, ID_CARTA_LE, None)
+
+
+class CardDataCache(object):
+    """Cache LRU con TTL dei record letti da get_ts_data, per (ATR, ID carta)."""
+
+    def __init__(self, max_entries=64, ttl=300.0, reader=get_ts_data):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.reader = reader
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()     # (atr, card_id) -> (scadenza, ts_data)
+        self.hits = 0
+        self.misses = 0
+
+    def read_card_id(self, connection):
+        """Legge il numero di serie della carta, selezionando l'EF ID_Carta solo se necessario."""
+        le = getattr(connection, ID_CARTA_LE, None)
+        if le is None:
+            if select_path(connection, PATH_EF_ID_CARTA) is None:
+                debug_msg("EF ID_Carta non disponibile")
+                return None
+            le = 0
+
+        try:
+            response, sw1, sw2 = execute_apdu(connection, READ_BIN[:4] + [le])
+        except CardStatusError as e:
+            debug_msg(f"Lettura dell'EF ID_Carta non riuscita: {e}")
+            forget_selection(connection)
+            return None
+        # Ricorda la lunghezza (corretta da un eventuale 6Cxx) per le letture successive
+        setattr(connection, ID_CARTA_LE, len(response) & 0xFF)
+        return bytes(response)
+
+    def get_ts_data(self, connection):
+        """Come get_ts_data(connection), ma restituisce il record in cache se la carta è la stessa."""
+        atr = bytes(connection.getATR())
+        card_id = self.read_card_id(connection)
+        if card_id is None:
+            # Senza identità la carta non può essere riconosciuta: lettura completa senza cache
+            self.misses += 1
+            return self.reader(connection)
+
+        key = (atr, card_id)
+        setattr(connection, CARD_KEY, key)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                debug_msg("Dati personali restituiti dalla cache")
+                return entry[1]
+            self.entries.pop(key, None)
+            self.misses += 1
+
+        # La lettura completa seleziona altri file: l'EF ID_Carta andrà riselezionato
+        forget_selection(connection)
+        ts_data = self.reader(connection)
+        if ts_data is not None:
+            with self.lock:
+                self.entries[key] = (now + self.ttl, ts_data)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return ts_data
+
+    def invalidate(self, connection=None):
+        """Invalida la voce della carta letta su una connessione e il suo stato di selezione
+        (tutte le voci se senza argomenti)."""
+        if connection is None:
+            with self.lock:
+                self.entries.clear()
+            return
+        key = getattr(connection, CARD_KEY, None)
+        if key is not None:
+            with self.lock:
+                self.entries.pop(key, None)
+            setattr(connection, CARD_KEY, None)
+        forget_selection(connection)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
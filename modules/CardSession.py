@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Servizio di sessione PC/SC di lunga durata per la lettura della TS-CNS.
+
+Il CardSessionManager mantiene aperti i lettori e le connessioni alle carte: finché
+la carta resta inserita, ogni lettura costa solo il tempo degli APDU, senza
+enumerazione dei lettori né connessione. La rimozione della carta (notificata dal
+CardMonitor di pyscard) invalida la connessione; reset e riconnessioni sono gestiti
+in modo trasparente.
+
+Il MultiReaderWatcher osserva invece tutti i lettori collegati e legge in parallelo
+le carte inserite, con un worker dedicato per ogni lettore.
+
+Esempio:
+    sessions = CardSessionManager()
+    ts_data = sessions.read_personal_data()
+    ...
+    sessions.close()
+
+Autore: Antonio Musarra <antonio.musarra[at]gmail.com>
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from smartcard.CardMonitoring import CardMonitor, CardObserver
+from smartcard.System import readers
+
+from modules.TSCNSCard import NoSmartCardReaderFound, NoSmartCardInserted, debug_msg, warn_msg, get_ts_data
+from modules.CardDataCache import forget_selection
+
+
+class CardSessionManager(CardObserver):
+    """Mantiene una connessione aperta per ogni lettore finché la carta resta inserita."""
+
+    def __init__(self, monitor=True, cache=None):
+        # cache: CardDataCache opzionale, per non rileggere i dati della stessa carta
+        self.cache = cache
+        self.lock = threading.RLock()
+        self.readers = {}
+        self.connections = {}
+        self.monitor = None
+        self.refresh_readers()
+        if monitor:
+            # Le notifiche di inserimento/rimozione arrivano dal thread del CardMonitor
+            self.monitor = CardMonitor()
+            self.monitor.addObserver(self)
+
+    def refresh_readers(self):
+        """Aggiorna l'elenco dei lettori disponibili."""
+        with self.lock:
+            self.readers = {str(reader): reader for reader in readers()}
+            debug_msg(f"Lettori disponibili: {list(self.readers)}")
+            return list(self.readers)
+
+    def reader_names(self):
+        with self.lock:
+            return list(self.readers)
+
+    def resolve_reader(self, reader=None):
+        """Restituisce il nome del lettore richiesto (il primo se non indicato)."""
+        with self.lock:
+            if reader is not None and not isinstance(reader, str):
+                reader = str(reader)
+            # I lettori vengono enumerati di nuovo solo se quello richiesto non è tra i noti
+            if not self.readers or reader is not None and reader not in self.readers:
+                self.refresh_readers()
+            if not self.readers:
+                raise NoSmartCardReaderFound("Nessun lettore di smart card trovato")
+            if reader is None:
+                return next(iter(self.readers))
+            if reader not in self.readers:
+                raise NoSmartCardReaderFound(f"Lettore non trovato: {reader}")
+            return reader
+
+    def connection(self, reader=None):
+        """Restituisce la connessione aperta verso la carta, creandola solo se necessario."""
+        with self.lock:
+            name = self.resolve_reader(reader)
+            connection = self.connections.get(name)
+            if connection is None:
+                connection = self.readers[name].createConnection()
+                try:
+                    connection.connect()
+                except Exception as e:
+                    raise NoSmartCardInserted(f"Impossibile connettersi alla smart card: {e}")
+                debug_msg(f"Connessione alla smart card stabilita su {name}")
+                self.connections[name] = connection
+            return connection
+
+    def reset(self, reader=None):
+        """Chiude la connessione di un lettore: la successiva lettura si riconnette."""
+        self.drop_connection(self.resolve_reader(reader))
+
+    def drop_connection(self, name):
+        with self.lock:
+            connection = self.connections.pop(name, None)
+        if connection is not None:
+            if self.cache is not None:
+                self.cache.invalidate(connection=connection)
+            try:
+                connection.disconnect()
+            except Exception as e:
+                debug_msg(f"Errore durante la disconnessione: {e}")
+
+    def get_atr(self, reader=None):
+        return self.connection(reader).getATR()
+
+    def transmit(self, apdu, reader=None):
+        """Invia un APDU sulla connessione aperta del lettore."""
+        with self.lock:
+            connection = self.connection(reader)
+            # L'APDU può selezionare un altro file: la cache deve riselezionare l'EF ID_Carta
+            forget_selection(connection)
+            return connection.transmit(apdu)
+
+    def read_personal_data(self, reader=None):
+        """Legge i dati personali riusando la connessione aperta; riprova una volta dopo un reset."""
+        read = self.cache.get_ts_data if self.cache is not None else get_ts_data
+        with self.lock:
+            ts_data = read(self.connection(reader))
+            if ts_data is None:
+                # La carta può essere stata resettata o sostituita: nuova connessione e nuovo tentativo
+                warn_msg("Lettura non riuscita, riconnessione alla smart card")
+                self.reset(reader)
+                ts_data = read(self.connection(reader))
+            return ts_data
+
+    def update(self, observable, actions):
+        """Notifica del CardMonitor: chiude le connessioni delle carte rimosse."""
+        (added_cards, removed_cards) = actions
+        for card in removed_cards:
+            debug_msg(f"Smart card rimossa dal lettore {card.reader}")
+            # Invalida anche la voce in cache della carta letta su questo lettore
+            self.drop_connection(str(card.reader))
+
+    def close(self):
+        if self.monitor is not None:
+            self.monitor.deleteObserver(self)
+            self.monitor = None
+        with self.lock:
+            for name in list(self.connections):
+                self.drop_connection(name)
+
+
+class MultiReaderWatcher(CardObserver):
+    """Legge ogni carta inserita in uno qualsiasi dei lettori, con un worker per lettore.
+
+    Le letture su lettori diversi procedono in parallelo, quelle sullo stesso lettore in
+    sequenza. Per ogni carta viene chiamato callback(reader, ts_data, error) dal thread
+    del worker: error è l'eccezione della lettura, oppure None. Se indicato, removed(reader)
+    viene chiamato, dal thread del CardMonitor, a ogni rimozione di una carta.
+    """
+
+    def __init__(self, callback, read=get_ts_data, removed=None):
+        self.callback = callback
+        self.read = read
+        self.removed = removed
+        self.lock = threading.Lock()
+        self.workers = {}
+        self.monitor = None
+
+    def start(self):
+        """Avvia il monitoraggio: le carte già inserite vengono notificate subito."""
+        self.monitor = CardMonitor()
+        self.monitor.addObserver(self)
+
+    def worker(self, name):
+        with self.lock:
+            worker = self.workers.get(name)
+            if worker is None:
+                # Un solo thread per lettore: i lettori collegati dopo l'avvio hanno il loro
+                worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"reader-{len(self.workers)}")
+                self.workers[name] = worker
+            return worker
+
+    def update(self, observable, actions):
+        """Notifica del CardMonitor: accoda la lettura delle carte inserite."""
+        (added_cards, removed_cards) = actions
+        for card in removed_cards:
+            debug_msg(f"Smart card rimossa dal lettore {card.reader}")
+            if self.removed is not None:
+                self.removed(str(card.reader))
+        for card in added_cards:
+            name = str(card.reader)
+            debug_msg(f"Smart card inserita nel lettore {name}")
+            self.worker(name).submit(self.read_card, name, card)
+
+    def read_card(self, name, card):
+        connection = card.createConnection()
+        try:
+            connection.connect()
+        except Exception as e:
+            self.callback(name, None, NoSmartCardInserted(f"Impossibile connettersi alla smart card: {e}"))
+            return
+        try:
+            ts_data = self.read(connection)
+        except Exception as e:
+            self.callback(name, None, e)
+        else:
+            self.callback(name, ts_data, None)
+        finally:
+            try:
+                connection.disconnect()
+            except Exception as e:
+                debug_msg(f"Errore durante la disconnessione: {e}")
+
+    def stop(self, wait=True):
+        """Ferma il monitoraggio e attende (se wait) le letture in corso."""
+        if self.monitor is not None:
+            self.monitor.deleteObserver(self)
+            self.monitor = None
+        with self.lock:
+            workers = list(self.workers.values())
+            self.workers.clear()
+        for worker in workers:
+            worker.shutdown(wait=wait)
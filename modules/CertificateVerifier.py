@@ -0,0 +1,283 @@
+########################################################################
+# Filename    : CertificateVerifier.py
+# Description : In-process chain verification of the TS-CNS certificate
+########################################################################
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.serialization import Encoding
+except ImportError:  # pip install cryptography
+    x509 = None
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timezone
+import hashlib
+import os
+import re
+import threading
+import time
+
+# Where scripts/auto-update-gov-certificates.sh installs the government CAs
+GOV_CERTIFICATES_PATH = '/usr/local/share/ca-certificates'
+CERTIFICATE_EXTENSIONS = ('.crt', '.pem', '.cer')
+PEM_CERTIFICATE = re.compile(rb'-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----', re.DOTALL)
+
+# Outcome of a verification: valid is True only when reason is REASON_OK
+VerificationResult = namedtuple('VerificationResult',
+                                ['valid', 'reason', 'subject', 'issuer', 'not_after', 'chain', 'fingerprint'])
+
+REASON_OK = 'ok'
+REASON_INVALID_CERTIFICATE = 'invalid certificate'
+REASON_NOT_YET_VALID = 'certificate not yet valid'
+REASON_EXPIRED = 'certificate expired'
+REASON_UNKNOWN_ISSUER = 'unable to get issuer certificate'
+REASON_BAD_SIGNATURE = 'certificate signature failure'
+REASON_ISSUER_NOT_CA = 'issuer is not a CA'
+REASON_ISSUER_EXPIRED = 'issuer certificate expired'
+REASON_REVOKED = 'certificate revoked'
+REASON_CRL_EXPIRED = 'CRL of the issuer expired'
+
+
+class CertificateError(Exception):
+    pass
+
+
+def not_valid_before(certificate):
+    if hasattr(certificate, 'not_valid_before_utc'):
+        return certificate.not_valid_before_utc
+    return certificate.not_valid_before.replace(tzinfo=timezone.utc)
+
+
+def not_valid_after(certificate):
+    if hasattr(certificate, 'not_valid_after_utc'):
+        return certificate.not_valid_after_utc
+    return certificate.not_valid_after.replace(tzinfo=timezone.utc)
+
+
+def is_ca(certificate):
+    """ CA unless the basicConstraints extension says otherwise (old roots lack it) """
+    try:
+        return certificate.extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+    except x509.ExtensionNotFound:
+        return True
+
+
+class TrustStore(object):
+    """ Trusted CA certificates loaded into memory once, indexed by subject.
+        Every certificate of the store is a trust anchor, as the government CAs
+        published in the Italian trusted list are trusted directly. """
+
+    def __init__(self, path=GOV_CERTIFICATES_PATH):
+        if x509 is None:
+            raise CertificateError("cryptography is not installed (pip install cryptography)")
+        self.path = path
+        self.lock = threading.Lock()
+        self.by_subject = {}
+        self.signature = None
+        self.version = 0
+        self.reload()
+
+    def files(self):
+        if os.path.isfile(self.path):
+            return [self.path]
+        return sorted(os.path.join(self.path, name) for name in os.listdir(self.path)
+                      if name.lower().endswith(CERTIFICATE_EXTENSIONS))
+
+    def current_signature(self):
+        """ Names, sizes and modification times of the store files: changes when the store is updated """
+        signature = []
+        for filename in self.files():
+            stat = os.stat(filename)
+            signature.append((filename, stat.st_size, stat.st_mtime_ns))
+        return tuple(signature)
+
+    def reload(self):
+        """ (Re)load every certificate of the store; a file may contain several PEM certificates """
+        by_subject = {}
+        for filename in self.files():
+            with open(filename, 'rb') as certificate_file:
+                data = certificate_file.read()
+            blocks = PEM_CERTIFICATE.findall(data) or [data]
+            for block in blocks:
+                try:
+                    if block.startswith(b'-----'):
+                        certificate = x509.load_pem_x509_certificate(block)
+                    else:
+                        certificate = x509.load_der_x509_certificate(block)
+                except ValueError:
+                    continue  # not a certificate
+                by_subject.setdefault(certificate.subject.public_bytes(), []).append(certificate)
+        with self.lock:
+            self.by_subject = by_subject
+            self.signature = self.current_signature()
+            self.version += 1
+
+    def refresh(self):
+        """ Reload the store if its files changed; True if it was reloaded """
+        if self.current_signature() == self.signature:
+            return False
+        self.reload()
+        return True
+
+    def issuers(self, certificate):
+        with self.lock:
+            return self.by_subject.get(certificate.issuer.public_bytes(), [])
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(certificates) for certificates in self.by_subject.values())
+
+
+class VerificationCache(object):
+    """ LRU cache of verification results keyed by the SHA-256 fingerprint of the certificate.
+        An entry lives at most ttl seconds and never past the certificate notAfter (nor, with a
+        CRL index, past the earliest CRL nextUpdate); the whole cache is dropped when the trust
+        store is reloaded or the CRL index is replaced. """
+
+    def __init__(self, trust_store, max_entries=256, ttl=3600.0, refresh_interval=5.0, crl_index=None):
+        self.trust_store = trust_store
+        self.crl_index = crl_index
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # fingerprint -> (monotonic expiry, notAfter, result)
+        self.version = trust_store.version
+        self.crl_generation = crl_index.generation if crl_index is not None else None
+        self.next_refresh = time.monotonic() + refresh_interval
+        self.hits = 0
+        self.misses = 0
+
+    def check_trust_store(self, now):
+        """ Reload the trust store and the CRL index if they changed (at most every refresh_interval seconds) """
+        if now >= self.next_refresh:
+            self.next_refresh = now + self.refresh_interval
+            self.trust_store.refresh()
+        if self.crl_index is not None:
+            self.crl_index.reload()  # rate limited by the index itself
+        if self.trust_store.version != self.version:
+            self.entries.clear()
+            self.version = self.trust_store.version
+        if self.crl_index is not None and self.crl_index.generation != self.crl_generation:
+            self.entries.clear()
+            self.crl_generation = self.crl_index.generation
+
+    def get(self, fingerprint, now):
+        with self.lock:
+            monotonic_now = time.monotonic()
+            self.check_trust_store(monotonic_now)
+            entry = self.entries.get(fingerprint)
+            if entry is not None and entry[0] > monotonic_now and (entry[1] is None or now <= entry[1]):
+                self.entries.move_to_end(fingerprint)
+                self.hits += 1
+                return entry[2]
+            self.entries.pop(fingerprint, None)
+            self.misses += 1
+            return None
+
+    def put(self, fingerprint, result):
+        if result.reason in (REASON_NOT_YET_VALID, REASON_INVALID_CERTIFICATE):
+            return  # the outcome changes with time, or there is nothing to key on
+        not_after = result.not_after
+        if self.crl_index is not None and result.valid:
+            # A valid result holds only while the CRLs are current
+            next_update = self.crl_index.earliest_next_update()
+            if next_update is not None:
+                next_update = datetime.fromtimestamp(next_update, timezone.utc)
+                not_after = next_update if not_after is None else min(not_after, next_update)
+        with self.lock:
+            self.entries[fingerprint] = (time.monotonic() + self.ttl, not_after, result)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class CertificateVerifier(object):
+    """ Verifies a certificate chain against a TrustStore, without external processes.
+        With a VerificationCache, a certificate already seen is answered from its fingerprint
+        without parsing it or building the chain again; with a CRLIndex, revoked certificates
+        are refused. """
+
+    def __init__(self, trust_store, cache=None, crl_index=None):
+        self.trust_store = trust_store
+        self.cache = cache
+        self.crl_index = crl_index
+
+    def load(self, certificate):
+        """ Accept DER or PEM bytes, or an already parsed certificate """
+        if isinstance(certificate, (bytes, bytearray)):
+            certificate = bytes(certificate)
+            if certificate.startswith(b'-----'):
+                return x509.load_pem_x509_certificate(certificate)
+            return x509.load_der_x509_certificate(certificate)
+        return certificate
+
+    def der(self, certificate):
+        if isinstance(certificate, (bytes, bytearray)) and not certificate.startswith(b'-----'):
+            return bytes(certificate)
+        return self.load(certificate).public_bytes(Encoding.DER)
+
+    def issued_by(self, certificate, issuer):
+        try:
+            certificate.verify_directly_issued_by(issuer)
+            return True
+        except (ValueError, TypeError, InvalidSignature):
+            return False
+
+    def verify(self, certificate, now=None):
+        """ Check validity period and signature of certificate against its issuer in the trust store """
+        now = now or datetime.now(timezone.utc)
+        try:
+            fingerprint = hashlib.sha256(self.der(certificate)).hexdigest()
+        except ValueError:
+            return VerificationResult(False, REASON_INVALID_CERTIFICATE, None, None, None, [], None)
+        if self.cache is None:
+            return self.check(certificate, fingerprint, now)
+
+        result = self.cache.get(fingerprint, now)
+        if result is None:
+            result = self.check(certificate, fingerprint, now)
+            self.cache.put(fingerprint, result)
+        return result
+
+    def check(self, certificate, fingerprint, now):
+        try:
+            certificate = self.load(certificate)
+        except ValueError:
+            return VerificationResult(False, REASON_INVALID_CERTIFICATE, None, None, None, [], fingerprint)
+
+        def result(reason, chain):
+            return VerificationResult(reason == REASON_OK, reason, certificate.subject.rfc4514_string(),
+                                      certificate.issuer.rfc4514_string(), not_valid_after(certificate),
+                                      [c.subject.rfc4514_string() for c in chain], fingerprint)
+
+        if now < not_valid_before(certificate):
+            return result(REASON_NOT_YET_VALID, [certificate])
+        if now > not_valid_after(certificate):
+            return result(REASON_EXPIRED, [certificate])
+
+        # Several CAs may share a subject (renewed keys): take the one that signed
+        reason = REASON_UNKNOWN_ISSUER
+        for issuer in self.trust_store.issuers(certificate):
+            if not self.issued_by(certificate, issuer):
+                reason = REASON_BAD_SIGNATURE if reason == REASON_UNKNOWN_ISSUER else reason
+            elif not is_ca(issuer):
+                reason = REASON_ISSUER_NOT_CA
+            elif not not_valid_before(issuer) <= now <= not_valid_after(issuer):
+                reason = REASON_ISSUER_EXPIRED
+            else:
+                # Every certificate of the store is a trust anchor: the chain ends here
+                if self.crl_index is not None:
+                    if self.crl_index.is_revoked(certificate):
+                        return result(REASON_REVOKED, [certificate, issuer])
+                    if self.crl_index.is_stale(certificate, now.timestamp()):
+                        # Revocations published after the CRL nextUpdate would be missed
+                        return result(REASON_CRL_EXPIRED, [certificate, issuer])
+                return result(REASON_OK, [certificate, issuer])
+        return result(reason, [certificate])
@@ -0,0 +1,165 @@
+########################################################################
+# Filename    : I2CBusManager.py
+# Description : One shared, serialized SMBus handle per I2C bus
+########################################################################
+try:
+    import smbus
+except ImportError:  # not on a Raspberry Pi: pass a bus (e.g. SimulatedSMBus)
+    smbus = None
+import heapq
+import itertools
+import threading
+import time
+
+
+class I2CBusManager(object):
+    """ Owns the bus handle of one I2C bus and serializes every transaction on it.
+        Waiting transactions are served by priority (lower first), then in arrival order. """
+
+    PRIORITY_INTERACTIVE = 0    # LCD updates, keypad feedback
+    PRIORITY_BACKGROUND = 10    # scheduler, sensors, polling
+
+    managers = {}
+    managers_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, busnum=1, bus=None):
+        """ Return the manager of a bus number, creating it on first use """
+        with cls.managers_lock:
+            if busnum not in cls.managers:
+                cls.managers[busnum] = cls(busnum, bus)
+            elif bus is not None and bus is not cls.managers[busnum].bus:
+                raise ValueError("I2C bus %d is already managed with another bus handle" % busnum)
+            return cls.managers[busnum]
+
+    def __init__(self, busnum=1, bus=None):
+        self.busnum = busnum
+        self.bus = bus if bus is not None else smbus.SMBus(busnum)
+        self.cond = threading.Condition()
+        self.waiting = []           # heap of (priority, ticket)
+        self.tickets = itertools.count()
+        self.owner = None
+        self.depth = 0
+        self.devices = {}
+
+    def device(self, address, priority=PRIORITY_BACKGROUND, name=None):
+        """ Handle with the smbus.SMBus methods for one device, usable as PCF8574_I2C bus """
+        handle = I2CDevice(self, address, priority, name)
+        self.devices.setdefault(address, []).append(handle)
+        return handle
+
+    def acquire(self, priority):
+        """ Wait for the bus and return the time spent waiting (seconds) """
+        me = threading.current_thread()
+        start = time.monotonic()
+        with self.cond:
+            if self.owner is me:
+                self.depth += 1
+                return 0.0
+            ticket = (priority, next(self.tickets))
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while self.owner is not None or self.waiting[0] != ticket:
+                    self.cond.wait()
+            except BaseException:
+                # interrupted (e.g. KeyboardInterrupt): leave the queue, or the bus stays blocked
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.cond.notify_all()
+                raise
+            heapq.heappop(self.waiting)
+            self.owner = me
+            self.depth = 1
+        return time.monotonic() - start
+
+    def release(self):
+        with self.cond:
+            self.depth -= 1
+            if self.depth == 0:
+                self.owner = None
+                self.cond.notify_all()
+
+    def stats(self):
+        """ Per-device counters, keyed by device name """
+        result = {}
+        for handles in self.devices.values():
+            for handle in handles:
+                result[handle.name] = handle.stats()
+        return result
+
+    def close(self):
+        self.bus.close()
+
+
+class I2CDevice(object):
+    """ One device on a managed bus: every call is a locked transaction with accounting """
+
+    def __init__(self, manager, address, priority, name=None):
+        self.manager = manager
+        self.address = address
+        self.priority = priority
+        self.name = name or '0x%02X' % address
+        self.transactions = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def exclusive(self):
+        """ Keep the bus for a sequence of transactions: with device.exclusive(): ... """
+        return _Exclusive(self)
+
+    def transaction(self, function, size, *args):
+        waited = self.manager.acquire(self.priority)
+        start = time.monotonic()
+        try:
+            return function(*args)
+        finally:
+            self.busy_time += time.monotonic() - start
+            self.manager.release()
+            self.transactions += 1
+            self.bytes += size
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def write_byte(self, address, value):
+        return self.transaction(self.manager.bus.write_byte, 1, address, value)
+
+    def write_i2c_block_data(self, address, cmd, values):
+        return self.transaction(self.manager.bus.write_i2c_block_data, 1 + len(values), address, cmd, values)
+
+    def read_byte(self, address):
+        return self.transaction(self.manager.bus.read_byte, 1, address)
+
+    def read_i2c_block_data(self, address, cmd, length=32):
+        return self.transaction(self.manager.bus.read_i2c_block_data, length, address, cmd, length)
+
+    def close(self):
+        pass  # the bus belongs to the manager
+
+    def stats(self):
+        return {
+            'transactions': self.transactions,
+            'bytes': self.bytes,
+            'busy_time': self.busy_time,
+            'bytes_per_second': self.busy_time and self.bytes / self.busy_time or 0.0,
+            'wait_time': self.wait_time,
+            'max_wait': self.max_wait,
+            'mean_wait': self.transactions and self.wait_time / self.transactions or 0.0,
+        }
+
+
+class _Exclusive(object):
+
+    def __init__(self, device):
+        self.device = device
+
+    def __enter__(self):
+        waited = self.device.manager.acquire(self.device.priority)
+        self.device.wait_time += waited
+        self.device.max_wait = max(self.device.max_wait, waited)
+        return self.device
+
+    def __exit__(self, *exc):
+        self.device.manager.release()
+        return False
@@ -4,38 +4,221 @@
 # Author      : freenove
 # modification: 2018/08/03
 ########################################################################
-import smbus
+try:
+    import smbus
+except ImportError:  # not on a Raspberry Pi: only SimulatedSMBus can be used
+    smbus = None
 import time
+import threading
+import queue
+
+class SimulatedSMBus(object):
+    # In-memory stand-in for smbus.SMBus: records every transaction with its
+    # timestamp and accounts a simulated bus time, so the LCD stack can be
+    # run and measured without a Raspberry Pi.
+    def __init__(self,latency_us=0,bus_hz=100000,realtime=False):
+        self.latency_us = latency_us    # fixed cost of each transaction (driver, START/STOP)
+        self.bus_hz = bus_hz
+        self.realtime = realtime        # really sleep for the simulated time
+        self.ports = {}
+        self.pulled_low = {}            # address -> mask of pins held low from outside
+        self.reset()
+
+    def reset(self):
+        self.transactions = []          # (timestamp, kind, address, data)
+        self.simulated_time = 0.0
+
+    def transfer(self,kind,address,data):
+        # address byte + payload, 9 clocks each (8 bits + ACK)
+        duration = self.latency_us / 1000000.0 + (1 + len(data)) * 9.0 / self.bus_hz
+        self.simulated_time += duration
+        if self.realtime:
+            time.sleep(duration)
+        self.transactions.append((time.monotonic(),kind,address,tuple(data)))
+
+    def write_byte(self,address,value):
+        self.transfer('write_byte',address,[value])
+        self.ports[address] = value
+
+    def write_i2c_block_data(self,address,cmd,values):
+        data = [cmd] + list(values)
+        self.transfer('write_block',address,data)
+        self.ports[address] = data[-1]
+
+    def read_byte(self,address):
+        self.transfer('read_byte',address,[])
+        return self.ports.get(address,0xFF) & ~self.pulled_low.get(address,0) & 0xFF
+
+    def drive(self,address,pin,level):#Simulate an external device on a quasi-bidirectional pin
+        if level:
+            self.pulled_low[address] = self.pulled_low.get(address,0) & ~(1<<pin)
+        else:
+            self.pulled_low[address] = self.pulled_low.get(address,0) | (1<<pin)
+
+    def close(self):
+        pass
+
+    def written(self,address):#All bytes latched on the port of a device, in order
+        values = []
+        for timestamp,kind,addr,data in self.transactions:
+            if addr == address and kind.startswith('write'):
+                values.extend(data)
+        return values
+
+    def decodeLCD(self,address,pin_rs=0,pin_e=2,pins_db=(4,5,6,7)):
+        # Rebuild the HD44780 traffic from the expander output: a nibble is
+        # latched on every falling edge of E, two nibbles make a byte.
+        # Returns ('cmd', byte) and ('char', byte) tuples.
+        events = []
+        high = None
+        previous = 0
+        for value in self.written(address):
+            if previous & (1<<pin_e) and not value & (1<<pin_e):
+                nibble = 0
+                for i in range(4):
+                    if value & (1<<pins_db[i]):
+                        nibble |= 1<<i
+                if high is None:
+                    high = nibble
+                else:
+                    events.append((value & (1<<pin_rs) and 'char' or 'cmd',(high<<4)|nibble))
+                    high = None
+            previous = value
+        return events
+
+    def stats(self,address=None):
+        transactions = [t for t in self.transactions if address is None or t[2] == address]
+        return {
+            'transactions': len(transactions),
+            'bytes': sum(len(t[3]) for t in transactions),
+            'simulated_time': self.simulated_time,
+        }
+
 class PCF8574_I2C(object):
     OUPUT = 0
     INPUT = 1
+    BLOCK_SIZE = 32     # SMBus block transfers carry at most 32 data bytes
     
-    def __init__(self,address):
+    def __init__(self,address,bus=None):
         # Note you need to change the bus number to 0 if running on a revision 1 Raspberry Pi.
-        self.bus = smbus.SMBus(1)
+        # Any object with the smbus.SMBus methods can be given as bus (e.g. SimulatedSMBus).
+        self.bus = bus if bus is not None else smbus.SMBus(1)
         self.address = address
         self.currentValue = 0
+        self.inputMask = 0  # pins used as inputs, always written high
+        self.writeLock = threading.RLock()  # keeps read-modify-write of the latch atomic across threads
         self.writeByte(0)   #I2C test.
+        self.lastInputs = 0
+        self.interruptPin = None
+        self.events = queue.Queue()     # debounced (timestamp, pin, value) changes
+        self.callback = None
+        self.debounceTimers = {}
+        self.lock = threading.Lock()
         
     def readByte(self):#Read PCF8574 all port of the data
-        #value = self.bus.read_byte(self.address)
-        return self.currentValue#value
+        # Quasi-bidirectional port: a pin written high reads back its real level
+        return self.bus.read_byte(self.address)
+
+    def outputByte(self):#Last value written to PCF8574 port, without bus traffic
+        return self.currentValue
         
     def writeByte(self,value):#Write data to PCF8574 port
-        self.currentValue = value
-        self.bus.write_byte(self.address,value)
+        value |= self.inputMask
+        with self.writeLock:
+            self.currentValue = value
+            self.bus.write_byte(self.address,value)
+
+    def setInput(self,pin):#Use one port as input: it must be latched high to be read
+        self.inputMask |= (1<<pin)
+        self.writeByte(self.currentValue)
+
+    def setOutput(self,pin):
+        self.inputMask &= ~(1<<pin)
+
+    def writeBlock(self,values):#Write a sequence of data to PCF8574 port in bulk transfers
+        # The PCF8574 has no registers: the "command" byte of an SMBus block write
+        # is latched on the port like any other byte, so every transfer moves
+        # BLOCK_SIZE + 1 consecutive port values with a single START/STOP.
+        if self.inputMask:
+            values = [value | self.inputMask for value in values]
+        else:
+            values = list(values)
+        step = self.BLOCK_SIZE + 1
+        with self.writeLock:
+            for i in range(0, len(values), step):
+                chunk = values[i:i+step]
+                if len(chunk) == 1:
+                    self.bus.write_byte(self.address,chunk[0])
+                else:
+                    self.bus.write_i2c_block_data(self.address,chunk[0],chunk[1:])
+            if values:
+                self.currentValue = values[-1]
 
     def digitalRead(self,pin):#Read PCF8574 one port of the data
-        value = readByte()  
+        value = self.readByte()
         return (value&(1<<pin)==(1<<pin)) and 1 or 0
+
+    def enableInterrupt(self,int_pin,callback=None,debounce_ms=20,gpio=None):
+        # The open-drain INT line of the PCF8574 goes low when an input changes.
+        # Every falling edge costs one bus read; changed pins are reported after
+        # they have been stable for debounce_ms, on self.events and to callback(pin,value).
+        if gpio is None:
+            import RPi.GPIO as gpio
+        self.callback = callback
+        self.debounce = debounce_ms / 1000.0
+        self.lastInputs = self.readByte() & self.inputMask
+        self.reported = self.lastInputs
+        self.interruptPin = int_pin
+        self.gpio = gpio
+        gpio.setup(int_pin,gpio.IN,pull_up_down=gpio.PUD_UP)
+        gpio.add_event_detect(int_pin,gpio.FALLING,callback=self.onInterrupt)
+
+    def disableInterrupt(self):
+        if self.interruptPin is None:
+            return
+        self.gpio.remove_event_detect(self.interruptPin)
+        self.interruptPin = None
+        with self.lock:
+            for timer in self.debounceTimers.values():
+                timer.cancel()
+            self.debounceTimers = {}
+
+    def onInterrupt(self,channel=None):#Read the port once and diff it against the previous state
+        value = self.readByte() & self.inputMask
+        with self.lock:
+            changed = value ^ self.lastInputs
+            self.lastInputs = value
+            for pin in range(8):
+                if changed & (1<<pin):
+                    # restart the quiet period of a bouncing pin
+                    timer = self.debounceTimers.get(pin)
+                    if timer is not None:
+                        timer.cancel()
+                    timer = threading.Timer(self.debounce,self.settle,(pin,))
+                    timer.daemon = True
+                    self.debounceTimers[pin] = timer
+                    timer.start()
+
+    def settle(self,pin):
+        with self.lock:
+            self.debounceTimers.pop(pin,None)
+            level = self.lastInputs & (1<<pin)
+            if level == self.reported & (1<<pin):
+                return  # bounced back to the reported state
+            self.reported ^= (1<<pin)
+        value = level and 1 or 0
+        self.events.put((time.monotonic(),pin,value))
+        if self.callback is not None:
+            self.callback(pin,value)
         
     def digitalWrite(self,pin,newvalue):#Write data to PCF8574 one port
-        value = self.currentValue #bus.read_byte(address)
-        if(newvalue == 1):
-            value |= (1<<pin)
-        elif (newvalue == 0):
-            value &= ~(1<<pin)
-        self.writeByte(value)   
+        with self.writeLock:
+            value = self.currentValue #bus.read_byte(address)
+            if(newvalue == 1):
+                value |= (1<<pin)
+            elif (newvalue == 0):
+                value &= ~(1<<pin)
+            self.writeByte(value)
 
 def loop():
     mcp = PCF8574_I2C(0x27)
@@ -54,17 +237,30 @@ class PCF8574_GPIO(object):#Standardization function interface
     IN = 1
     BCM = 0
     BOARD = 0
-    def __init__(self,address):
-        self.chip = PCF8574_I2C(address)
+    def __init__(self,address,bus=None):
+        self.chip = PCF8574_I2C(address,bus)
         self.address = address
     def setmode(self,mode):#PCF8574 port belongs to two-way IO, do not need to set the input and output model
         pass
     def setup(self,pin,mode):
-        pass
+        if mode == self.IN:
+            self.chip.setInput(pin)
+        else:
+            self.chip.setOutput(pin)
     def input(self,pin):#Read PCF8574 one port of the data
         return self.chip.digitalRead(pin)
     def output(self,pin,value):#Write data to PCF8574 one port
         self.chip.digitalWrite(pin,value)
+    def readByte(self):#Read PCF8574 all port of the data
+        return self.chip.readByte()
+    def outputByte(self):#Last value written to PCF8574 port
+        return self.chip.outputByte()
+    def enableInterrupt(self,int_pin,callback=None,debounce_ms=20,gpio=None):#Debounced input events from the INT line
+        self.chip.enableInterrupt(int_pin,callback,debounce_ms,gpio)
+    def disableInterrupt(self):
+        self.chip.disableInterrupt()
+    def writeBlock(self,values):#Write a sequence of data to PCF8574 port in bulk transfers
+        self.chip.writeBlock(values)
         
 def destroy():
     bus.close()
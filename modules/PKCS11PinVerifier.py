@@ -0,0 +1,199 @@
+########################################################################
+# Filename    : PKCS11PinVerifier.py
+# Description : In-process PIN verification of the TS-CNS via PKCS#11
+########################################################################
+try:
+    import PyKCS11
+except ImportError:  # pip install PyKCS11
+    PyKCS11 = None
+import os
+import threading
+
+# Where OpenSC installs its PKCS#11 module on the usual distributions
+PKCS11_MODULE_PATHS = [
+    '/usr/lib/arm-linux-gnueabihf/opensc-pkcs11.so',
+    '/usr/lib/aarch64-linux-gnu/opensc-pkcs11.so',
+    '/usr/lib/x86_64-linux-gnu/opensc-pkcs11.so',
+    '/usr/local/lib/opensc-pkcs11.so',
+    '/usr/lib/opensc-pkcs11.so',
+    '/Library/OpenSC/lib/opensc-pkcs11.so',
+]
+
+
+class PinVerificationError(Exception):
+    pass
+
+
+class TokenNotPresent(PinVerificationError):
+    pass
+
+
+class PinLocked(PinVerificationError):
+    pass
+
+
+class TokenChanged(PinVerificationError):
+    pass
+
+
+def find_pkcs11_module():
+    """ PKCS11_MODULE environment variable, otherwise the first OpenSC module found """
+    path = os.environ.get('PKCS11_MODULE')
+    if path:
+        return path
+    for path in PKCS11_MODULE_PATHS:
+        if os.path.exists(path):
+            return path
+    raise PinVerificationError("OpenSC PKCS#11 module not found, set PKCS11_MODULE")
+
+
+class PKCS11PinVerifier(object):
+    """ Verifies the user PIN with C_Login/C_Logout on a session kept open per slot.
+        The PKCS#11 module is loaded once, so a verification costs only the login on the card.
+        Works with any PKCS#11 module: OpenSC for the TS-CNS, SoftHSM for testing. """
+
+    # Errors after which the session is stale (card removed or reinserted): reopen and retry
+    SESSION_ERRORS = ('CKR_SESSION_HANDLE_INVALID', 'CKR_SESSION_CLOSED', 'CKR_DEVICE_REMOVED',
+                      'CKR_TOKEN_NOT_RECOGNIZED', 'CKR_DEVICE_ERROR')
+    WRONG_PIN_ERRORS = ('CKR_PIN_INCORRECT', 'CKR_PIN_LEN_RANGE', 'CKR_PIN_INVALID')
+
+    def __init__(self, module=None):
+        if PyKCS11 is None:
+            raise PinVerificationError("PyKCS11 is not installed (pip install PyKCS11)")
+        self.module = module or find_pkcs11_module()
+        self.lib = PyKCS11.PyKCS11Lib()
+        try:
+            self.lib.load(self.module)
+        except PyKCS11.PyKCS11Error as e:
+            raise PinVerificationError(f"Cannot load {self.module}: {e}")
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def error_name(self, error):
+        return PyKCS11.CKR.get(error.value, str(error.value))
+
+    def slot(self):
+        """ First slot with a token inserted """
+        try:
+            slots = self.lib.getSlotList(tokenPresent=True)
+        except PyKCS11.PyKCS11Error as e:
+            raise PinVerificationError(f"Cannot list the slots: {self.error_name(e)}")
+        if not slots:
+            raise TokenNotPresent("No smart card inserted")
+        return slots[0]
+
+    def session(self, slot):
+        if slot not in self.sessions:
+            # A read-only session is enough to log in the user
+            self.sessions[slot] = self.lib.openSession(slot, PyKCS11.CKF_SERIAL_SESSION)
+        return self.sessions[slot]
+
+    def open(self, slot=None):
+        """ Open the session in advance (e.g. when the card is inserted) so verify() only logs in """
+        with self.lock:
+            try:
+                self.session(self.slot() if slot is None else slot)
+            except PyKCS11.PyKCS11Error as e:
+                raise PinVerificationError(f"Cannot open the session: {self.error_name(e)}")
+
+    def drop(self, slot):
+        session = self.sessions.pop(slot, None)
+        if session is not None:
+            try:
+                session.closeSession()
+            except PyKCS11.PyKCS11Error:
+                pass  # the token is already gone
+
+    def login(self, session, pin):
+        try:
+            session.login(pin)
+        except PyKCS11.PyKCS11Error as e:
+            if self.error_name(e) != 'CKR_USER_ALREADY_LOGGED_IN':
+                raise
+            session.logout()
+            session.login(pin)
+        session.logout()
+
+    def call(self, slot, operation):
+        """ Run operation(session) on the slot session, reopening a stale session once """
+        for attempt in (1, 2):
+            try:
+                return operation(self.session(slot))
+            except PyKCS11.PyKCS11Error as e:
+                name = self.error_name(e)
+                if name == 'CKR_TOKEN_NOT_PRESENT':
+                    self.drop(slot)
+                    raise TokenNotPresent("No smart card inserted")
+                if name in self.SESSION_ERRORS and attempt == 1:
+                    self.drop(slot)
+                    continue
+                raise
+
+    def verify(self, pin, slot=None):
+        """ True if the PIN is correct, False if it is wrong; PinLocked, TokenNotPresent or
+            PinVerificationError when the check cannot be done """
+        return self.verify_token(pin, slot)[0]
+
+    def verify_token(self, pin, slot=None):
+        """ Like verify(), but returns (is_correct, token serial): the serial is read before the
+            login and after the logout, TokenChanged is raised if the card was swapped meanwhile """
+        with self.lock:
+            slot = self.slot() if slot is None else slot
+            serial = self.serial(slot)
+            try:
+                self.call(slot, lambda session: self.login(session, pin))
+                is_correct = True
+            except PyKCS11.PyKCS11Error as e:
+                name = self.error_name(e)
+                if name in self.WRONG_PIN_ERRORS:
+                    is_correct = False
+                elif name == 'CKR_PIN_LOCKED':
+                    raise PinLocked("PIN locked, use the PUK to unlock it")
+                else:
+                    raise PinVerificationError(f"PIN verification failed: {name}")
+            if self.serial(slot) != serial:
+                raise TokenChanged("The smart card was replaced during the PIN check")
+            return is_correct, serial
+
+    def serial(self, slot):
+        try:
+            return self.lib.getTokenInfo(slot).serialNumber.strip()
+        except PyKCS11.PyKCS11Error as e:
+            name = self.error_name(e)
+            if name == 'CKR_TOKEN_NOT_PRESENT':
+                self.drop(slot)
+                raise TokenNotPresent("No smart card inserted")
+            raise PinVerificationError(f"Cannot read the token info: {name}")
+
+    def token_serial(self, slot=None):
+        """ Serial number of the token in the slot: tells whether the card is still the same one """
+        with self.lock:
+            return self.serial(self.slot() if slot is None else slot)
+
+    def read_certificate(self, cert_id=(0x01,), slot=None):
+        """ DER bytes of the card certificate with CKA_ID cert_id (the pkcs15-tool -r 01 one),
+            or of the first certificate when cert_id is None; no login is needed """
+        def find(session):
+            template = [(PyKCS11.CKA_CLASS, PyKCS11.CKO_CERTIFICATE)]
+            if cert_id is not None:
+                template.append((PyKCS11.CKA_ID, cert_id))
+            for certificate in session.findObjects(template):
+                value = session.getAttributeValue(certificate, [PyKCS11.CKA_VALUE], True)[0]
+                if value:
+                    return bytes(value)
+            return None
+
+        with self.lock:
+            slot = self.slot() if slot is None else slot
+            try:
+                certificate = self.call(slot, find)
+            except PyKCS11.PyKCS11Error as e:
+                raise PinVerificationError(f"Cannot read the certificate: {self.error_name(e)}")
+        if certificate is None:
+            raise PinVerificationError("No certificate found on the card")
+        return certificate
+
+    def close(self):
+        with self.lock:
+            for slot in list(self.sessions):
+                self.drop(slot)
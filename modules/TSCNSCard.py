@@ -0,0 +1,555 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Modulo con le funzioni per leggere i dati personali dalla TS-CNS tramite comandi APDU.
+
+Le funzioni lavorano su un oggetto connessione che espone il metodo transmit(apdu)
+(ad esempio quello restituito da pyscard con reader.createConnection()), per cui
+possono essere usate sia dallo script read-ts-cns-data.py sia da servizi di lunga durata.
+
+Autore: Antonio Musarra <antonio.musarra[at]gmail.com>
+"""
+
+import threading
+
+from colorama import Fore
+
+# Abilita i messaggi di debug (impostato dagli script tramite set_debug)
+debug_enabled = False
+
+# Destinazione dei messaggi (None: sys.stdout) e uso dei colori, impostati con set_messages
+message_stream = None
+message_colors = True
+
+
+# Definizione delle eccezioni personalizzate
+class NoSmartCardReaderFound(Exception):
+    pass
+
+
+class NoSmartCardInserted(Exception):
+    pass
+
+
+class CardStatusError(Exception):
+    """La carta ha risposto con una status word di errore (sw1, sw2)."""
+
+    def __init__(self, sw1, sw2, message=None):
+        self.sw1 = sw1
+        self.sw2 = sw2
+        super().__init__(f"{message or 'Errore della carta'}: SW1={sw1:02X}, SW2={sw2:02X}")
+
+
+class TransmissionError(CardStatusError):
+    pass
+
+
+class WrongLength(CardStatusError):
+    pass
+
+
+class SecurityStatusNotSatisfied(CardStatusError):
+    pass
+
+
+class CommandNotAllowed(CardStatusError):
+    pass
+
+
+class FileNotFound(CardStatusError):
+    pass
+
+
+class WrongParameters(CardStatusError):
+    pass
+
+
+class InstructionNotSupported(CardStatusError):
+    pass
+
+
+def set_debug(enabled):
+    """Abilita o disabilita i messaggi di debug."""
+    global debug_enabled
+    debug_enabled = enabled
+
+
+def set_messages(stream=None, colors=True):
+    """Invia i messaggi su stream (es. sys.stderr, per lasciare stdout ai dati) e abilita i colori."""
+    global message_stream, message_colors
+    message_stream = stream
+    message_colors = colors
+
+
+def color(code):
+    return code if message_colors else ''
+
+
+# Funzione per stampare messaggi di debug
+def debug_msg(message):
+    if debug_enabled:
+        print(f"{color(Fore.YELLOW)}🐞🛠️ {message}", file=message_stream)
+
+
+# Funzione per stampare messaggi di successo
+def success_msg(message):
+    print(f"{color(Fore.GREEN)}✅ {message}", file=message_stream)
+
+
+# Funzione per stampare errori
+def warn_msg(message):
+    print(f"{color(Fore.YELLOW)}⚠️ {message}", file=message_stream)
+
+
+# Funzione per stampare errori
+def error_msg(message):
+    print(f"{color(Fore.RED)}❌ {message}", file=message_stream)
+
+
+def to_hex_string(data):
+    """Rappresenta una sequenza di byte come stringa esadecimale (come smartcard.util.toHexString)."""
+    return ' '.join(f'{b:02X}' for b in data)
+
+
+def send_apdu(connection, apdu):
+    """Invia un comando APDU alla Smart Card e riceve la risposta."""
+    debug_msg(f"Inviando APDU: {apdu}")
+
+    try:
+        response, sw1, sw2 = connection.transmit(apdu)
+        status_str = f"SW1={sw1:02X}, SW2={sw2:02X}"
+        debug_msg(f"Risposta: {to_hex_string(response)} {status_str}")
+        return response, sw1, sw2
+    except Exception as e:
+        error_msg(f"Errore nell'invio dell'APDU: {e}")
+        return [], 0, 0
+
+
+# Status word di errore -> (eccezione, messaggio); le voci con sw2 None valgono per tutto l'SW1
+STATUS_ERRORS = {
+    (0x00, None): (TransmissionError, "Errore di trasmissione"),
+    (0x67, None): (WrongLength, "Lunghezza errata"),
+    (0x69, 0x82): (SecurityStatusNotSatisfied, "Condizioni di sicurezza non soddisfatte"),
+    (0x69, None): (CommandNotAllowed, "Comando non consentito"),
+    (0x6A, 0x82): (FileNotFound, "File non trovato"),
+    (0x6A, None): (WrongParameters, "Parametri P1/P2 errati"),
+    (0x6B, None): (WrongParameters, "Parametri P1/P2 errati"),
+    (0x6D, None): (InstructionNotSupported, "Istruzione non supportata"),
+    (0x6E, None): (InstructionNotSupported, "Classe non supportata"),
+}
+
+# Contatori degli APDU: comandi eseguiti, scambi con la carta e scambi aggiuntivi (61xx, 6Cxx, 67:00)
+apdu_stats = {'commands': 0, 'exchanges': 0, 'extra': 0}
+apdu_stats_lock = threading.Lock()
+
+
+def reset_apdu_stats():
+    with apdu_stats_lock:
+        for key in apdu_stats:
+            apdu_stats[key] = 0
+
+
+def get_apdu_stats():
+    with apdu_stats_lock:
+        return dict(apdu_stats)
+
+
+def status_error(sw1, sw2):
+    """Costruisce l'eccezione tipizzata per una status word di errore."""
+    error_class, message = STATUS_ERRORS.get((sw1, sw2)) or STATUS_ERRORS.get((sw1, None)) or \
+        (CardStatusError, None)
+    return error_class(sw1, sw2, message)
+
+
+def with_le(apdu, le):
+    """Restituisce l'APDU short con il campo Le sostituito, oppure None se l'APDU non ha un Le short."""
+    if len(apdu) == 5 or len(apdu) > 5 and apdu[4] and len(apdu) == 6 + apdu[4]:
+        return apdu[:-1] + [le]
+    return None
+
+
+def execute_apdu(connection, apdu, accept=()):
+    """Esegue un comando APDU gestendo le status word che richiedono altri scambi:
+
+    - 6Cxx: il comando viene ripetuto con il Le indicato dalla carta;
+    - 67:00 con Le=00 (256 byte): il comando viene ripetuto con Le=FF;
+    - 61xx: i dati restanti vengono recuperati concatenando GET RESPONSE.
+
+    Restituisce (response, sw1, sw2) se la status word finale è 90:00 o è in accept,
+    altrimenti solleva la CardStatusError corrispondente."""
+    apdu = list(apdu)
+    response, sw1, sw2 = send_apdu(connection, apdu)
+    exchanges = 1
+    if sw1 == 0x6C and with_le(apdu, sw2) is not None:
+        apdu = with_le(apdu, sw2)
+        response, sw1, sw2 = send_apdu(connection, apdu)
+        exchanges += 1
+    elif sw1 == 0x67 and sw2 == 0x00 and with_le(apdu, 0xFF) is not None and apdu[-1] == 0x00:
+        # Alcune carte non accettano Le=00 come 256 byte
+        apdu = with_le(apdu, 0xFF)
+        response, sw1, sw2 = send_apdu(connection, apdu)
+        exchanges += 1
+
+    data = list(response)
+    while sw1 == 0x61:  # T=0: altri dati disponibili con GET RESPONSE
+        response, sw1, sw2 = send_apdu(connection, [0x00, 0xC0, 0x00, 0x00, sw2])
+        data.extend(response)
+        exchanges += 1
+
+    with apdu_stats_lock:
+        apdu_stats['commands'] += 1
+        apdu_stats['exchanges'] += exchanges
+        apdu_stats['extra'] += exchanges - 1
+
+    if sw1 == 0x90 and sw2 == 0x00 or (sw1, sw2) in accept:
+        return data, sw1, sw2
+    raise status_error(sw1, sw2)
+
+
+def hex_to_string(hex_data):
+    """Converte dati esadecimali in una stringa."""
+    result = ""
+    for i in range(0, len(hex_data), 2):
+        if i + 1 < len(hex_data):
+            # Prende due caratteri esadecimali e li converte in un carattere
+            char_code = int(hex_data[i:i + 2], 16)
+            # Verifica se il carattere è un ASCII stampabile
+            if 32 <= char_code <= 126:
+                result += chr(char_code)
+            else:
+                result += '.'
+    return result
+
+
+def get_ts_data(connection, debug=False):
+    """Legge i dati personali dalla TS-CNS."""
+    # Seleziona l'Elementary File (EF) contenente i dati personali (MF -> DF1 -> EF) e lo legge
+    # per intero: la dimensione viene dall'FCI, gli EF oltre i 256 byte sono letti a blocchi
+    data = read_ef(connection, PATH_EF_PERS)
+    if data is None:
+        error_msg("Errore durante la lettura dell'EF dei dati personali")
+        return None
+    response = list(data)
+
+    debug_msg("Dati letti con successo")
+
+    # Elabora e restituisci i dati letti
+    hex_data = ''.join([f'{b:02X}' for b in response])
+
+    # Aggiungi la decodifica
+    decoded_data = decode_ts_data(response)
+
+    return {
+        'raw_data': response,
+        'hex_data': hex_data,
+        'string_data': hex_to_string(hex_data),
+        'decoded_data': decoded_data
+    }
+
+
+# Limiti dei campi Le per le APDU short ed extended
+SHORT_LE_MAX = 256
+EXTENDED_LE_MAX = 65536
+MAX_OFFSET = 0x7FFF  # READ BINARY con offset in P1/P2 (bit 8 di P1 a zero)
+
+
+def parse_path(path):
+    """Converte un percorso ("3F00/1100/1102", "3F0011001102" o lista di FID) in una lista di FID."""
+    if isinstance(path, str):
+        path = path.replace('/', '')
+        return [int(path[i:i + 4], 16) for i in range(0, len(path), 4)]
+    return list(path)
+
+
+def find_file_size(fci):
+    """Estrae la dimensione del file (tag 80, altrimenti 81) dal template FCP/FCI restituito dalla SELECT."""
+    size = None
+    pos = 0
+    while pos + 2 <= len(fci):
+        tag = fci[pos]
+        length = fci[pos + 1]
+        pos += 2
+        if length == 0x81:
+            length = fci[pos]
+            pos += 1
+        elif length == 0x82:
+            length = (fci[pos] << 8) | fci[pos + 1]
+            pos += 2
+        value = fci[pos:pos + length]
+        if tag in (0x62, 0x64, 0x6F):
+            # template: i tag della dimensione sono al suo interno
+            return find_file_size(value)
+        if tag == 0x80 and value:
+            return int.from_bytes(bytes(value), 'big')
+        if tag == 0x81 and value and size is None:
+            size = int.from_bytes(bytes(value), 'big')
+        pos += length
+    return size
+
+
+def supports_extended_length(atr):
+    """Verifica nei caratteri storici dell'ATR se la carta dichiara il supporto alle APDU extended."""
+    if len(atr) < 2:
+        return False
+    t0 = atr[1]
+    historical_count = t0 & 0x0F
+    y = t0 >> 4
+    pos = 2
+    # Salta i caratteri di interfaccia TAi, TBi, TCi, TDi
+    while True:
+        pos += bin(y & 0x07).count('1')
+        if not y & 0x08:
+            break
+        y = atr[pos] >> 4
+        pos += 1
+    historical = atr[pos:pos + historical_count]
+    if not historical or historical[0] not in (0x00, 0x80):
+        return False
+    # Oggetti compact-TLV: il tag 7 (card capabilities) indica le APDU extended nel terzo byte
+    pos = 1
+    end = len(historical) - (3 if historical[0] == 0x00 else 0)
+    while pos < end:
+        tag = historical[pos] >> 4
+        length = historical[pos] & 0x0F
+        value = historical[pos + 1:pos + 1 + length]
+        if tag == 0x7 and len(value) >= 3:
+            return bool(value[2] & 0x40)
+        pos += 1 + length
+    return False
+
+
+def select_file(connection, fid):
+    """Seleziona un file per FID e restituisce la risposta (FCI, eventualmente via GET RESPONSE)."""
+    try:
+        response, sw1, sw2 = execute_apdu(connection, [0x00, 0xA4, 0x00, 0x00, 0x02, fid >> 8, fid & 0xFF])
+    except CardStatusError as e:
+        error_msg(f"Errore durante la selezione del file {fid:04X}: {e}")
+        return None
+    return response
+
+
+# Percorsi dal MF dei file della TS-CNS
+PATH_EF_PERS = [0x3F00, 0x1100, 0x1102]      # dati personali
+PATH_EF_ID_CARTA = [0x3F00, 0x1000, 0x1003]  # numero di serie della carta
+
+# Modalità di SELECT che funziona per ciascun ATR: SELECT_BY_PATH o SELECT_STEP_BY_STEP
+SELECT_BY_PATH = 'path'
+SELECT_STEP_BY_STEP = 'step'
+select_modes = {}
+
+
+def select_path(connection, path):
+    """Seleziona un file per percorso dal MF e restituisce l'FCI (None in caso di errore).
+
+    Se la carta la supporta viene usata un'unica SELECT by path (P1=08), altrimenti il
+    percorso viene percorso un FID alla volta. La modalità che funziona viene ricordata
+    per l'ATR della carta, così le carte senza SELECT by path non pagano un tentativo
+    a vuoto a ogni lettura."""
+    fids = parse_path(path)
+    if fids and fids[0] == 0x3F00:
+        fids = fids[1:]  # con P1=08 il percorso parte dal MF, che non va indicato
+    try:
+        atr = bytes(connection.getATR())
+    except Exception:
+        atr = None
+    mode = select_modes.get(atr)
+
+    if mode != SELECT_STEP_BY_STEP and fids:
+        data = [byte for fid in fids for byte in (fid >> 8, fid & 0xFF)]
+        try:
+            response, sw1, sw2 = execute_apdu(connection, [0x00, 0xA4, 0x08, 0x00, len(data)] + data)
+        except CardStatusError as e:
+            if mode == SELECT_BY_PATH:
+                # La carta supporta la SELECT by path: l'errore riguarda il file
+                error_msg(f"Errore durante la selezione di {to_hex_string(data)}: {e}")
+                return None
+            debug_msg(f"SELECT by path non riuscita ({e}), selezione un file alla volta")
+        else:
+            if atr is not None:
+                select_modes[atr] = SELECT_BY_PATH
+            return response
+
+    response = select_file(connection, 0x3F00)
+    for fid in fids:
+        if response is None:
+            break
+        response = select_file(connection, fid)
+    if response is not None and atr is not None and mode is None and fids:
+        select_modes[atr] = SELECT_STEP_BY_STEP
+    return response
+
+
+def read_binary_extended(connection, offset, length):
+    """READ BINARY con Le extended (3 byte): restituisce i dati oppure None se non supportato."""
+    le = length if length < EXTENDED_LE_MAX else 0
+    try:
+        response, sw1, sw2 = execute_apdu(connection, [0x00, 0xB0, offset >> 8, offset & 0xFF, 0x00, le >> 8, le & 0xFF],
+                                          accept=((0x62, 0x82),))
+    except CardStatusError as e:
+        debug_msg(f"READ BINARY extended non supportata: {e}")
+        return None
+    return response
+
+
+def read_ef(connection, path, extended=None, chunk_size=SHORT_LE_MAX):
+    """Legge per intero un EF: la dimensione viene ricavata dall'FCI della SELECT e i dati letti
+    a blocchi con offset in P1/P2, o con un'unica APDU extended se la carta la supporta.
+    extended=None decide in base all'ATR. Restituisce i dati come bytes, None in caso di errore."""
+    fids = parse_path(path)
+    if fids and fids[0] == 0x3F00:
+        fci = select_path(connection, fids)
+        if fci is None:
+            return None
+    else:
+        fci = None
+        for fid in fids:
+            fci = select_file(connection, fid)
+            if fci is None:
+                return None
+
+    size = find_file_size(fci)
+    debug_msg(f"Dimensione dell'EF {path} dall'FCI: {size}")
+
+    if extended is None:
+        try:
+            extended = supports_extended_length(connection.getATR())
+        except Exception:
+            extended = False
+    if extended and size is not None and 0 < size <= min(EXTENDED_LE_MAX, MAX_OFFSET + 1):
+        data = read_binary_extended(connection, 0, size)
+        if data is not None:
+            return bytes(data)
+
+    data = bytearray()
+    chunk_size = min(chunk_size, SHORT_LE_MAX)
+    while size is None or len(data) < size:
+        offset = len(data)
+        if offset > MAX_OFFSET:
+            error_msg(f"Offset {offset} oltre il limite di READ BINARY")
+            return None
+        length = chunk_size if size is None else min(chunk_size, size - offset)
+        try:
+            # 6Cxx e 67:00 (Le=00 non accettato) sono gestiti da execute_apdu
+            response, sw1, sw2 = execute_apdu(connection, [0x00, 0xB0, offset >> 8, offset & 0xFF, length & 0xFF],
+                                              accept=((0x62, 0x82),))
+        except CardStatusError as e:
+            if e.sw1 == 0x6B:
+                break  # oltre la fine del file
+            error_msg(f"Errore durante la lettura dell'EF {path}: {e}")
+            return None
+        data.extend(response)
+        if length == SHORT_LE_MAX and len(response) == 0xFF:
+            # Le=00 rifiutato (o ridotto dalla carta): si prosegue con blocchi da 255
+            chunk_size = length = 0xFF
+        if not response or sw1 == 0x62 or size is None and len(response) < length:
+            break  # fine del file raggiunta
+
+    return bytes(data)
+
+
+def format_date(value):
+    """Formatta una data GGMMAAAA come GG/MM/AAAA."""
+    return f"{value[0:2]}/{value[2:4]}/{value[4:8]}"
+
+
+# Tracciato dell'EF dei dati personali: ogni campo è preceduto dalla sua lunghezza
+# espressa con due cifre esadecimali ASCII. (nome del campo, formattatore opzionale)
+TS_HEADER_SIZE = 6  # i primi 6 byte contengono la dimensione
+TS_FIELDS = (
+    ('emettitore', None),
+    ('data_emissione', format_date),
+    ('data_scadenza', format_date),
+    ('cognome', None),
+    ('nome', None),
+    ('data_nascita', format_date),
+    ('sesso', None),
+    ('statura', None),  # potrebbe essere vuota
+    ('codice_fiscale', None),
+    ('cittadinanza', None),
+    ('comune_nascita', None),
+)
+
+# Valore di ogni byte come cifra esadecimale ASCII. Le non-cifre valgono -256, così
+# una lunghezza con una cifra non valida risulta comunque negativa.
+HEX_DIGITS = [-256] * 256
+for digit, char in enumerate('0123456789ABCDEF'):
+    HEX_DIGITS[ord(char)] = digit
+    HEX_DIGITS[ord(char.lower())] = digit
+
+
+class TSRecord(object):
+    """Dati personali decodificati della TS-CNS; i campi vuoti valgono None."""
+    __slots__ = tuple(name for name, formatter in TS_FIELDS)
+
+    def as_dict(self):
+        """Dizionario con i soli campi valorizzati, nell'ordine del tracciato."""
+        return {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+
+    def __repr__(self):
+        return f"TSRecord({self.as_dict()})"
+
+
+def decode_ts_record(raw_data, fields=TS_FIELDS, hex_digits=HEX_DIGITS):
+    """Decodifica i dati personali in un TSRecord scorrendo il buffer senza copie intermedie.
+    Solleva ValueError se i dati non rispettano il tracciato."""
+    if not isinstance(raw_data, (bytes, bytearray, memoryview)):
+        raw_data = bytes(raw_data)
+    view = memoryview(raw_data)
+    # Le lunghezze si leggono dal memoryview; i valori sono sottostringhe di un'unica
+    # decodifica del buffer (latin-1 mappa ogni byte su un carattere)
+    text = str(view, 'latin-1')
+    end = len(view)
+    pos = TS_HEADER_SIZE
+    record = TSRecord()
+    for name, formatter in fields:
+        if pos + 2 > end:
+            raise ValueError(f"dati troncati prima del campo {name}")
+        field_len = hex_digits[view[pos]] * 16 + hex_digits[view[pos + 1]]
+        if field_len < 0:
+            raise ValueError(f"lunghezza non valida per il campo {name}")
+        pos += 2
+        if field_len:
+            value = text[pos:pos + field_len]
+            if not value.isascii():
+                raise ValueError(f"caratteri non ASCII nel campo {name}")
+            setattr(record, name, formatter(value) if formatter else value)
+            pos += field_len
+        else:
+            setattr(record, name, None)
+    return record
+
+
+def decode_ts_batch(dumps):
+    """Decodifica molti dump (ad esempio archiviati); per i dump non validi restituisce None."""
+    records = []
+    for raw_data in dumps:
+        try:
+            records.append(decode_ts_record(raw_data))
+        except ValueError:
+            records.append(None)
+    return records
+
+
+def decode_ts_data(raw_data):
+    """Decodifica i dati personali dalla TS-CNS interpretando i prefissi di lunghezza."""
+    try:
+        return decode_ts_record(raw_data).as_dict()
+
+    except Exception as e:
+        error_msg(f"Errore durante la decodifica: {e}")
+        if debug_enabled:
+            import traceback
+            traceback.print_exc(file=message_stream)
+        return None
+
+
+def dump_raw_data(raw_data):
+    """Mostra una rappresentazione dettagliata dei dati grezzi per analisi."""
+    ascii_dump = ''.join([chr(b) if 32 <= b <= 126 else '.' for b in raw_data])
+
+    debug_msg("Esadecimale:")
+    # Mostra 16 byte per riga
+    for i in range(0, len(raw_data), 16):
+        hex_line = ' '.join([f'{raw_data[j]:02X}' for j in range(i, min(i + 16, len(raw_data)))])
+        debug_msg(f"{i:04X}: {hex_line:48s}  {ascii_dump[i:i + 16]}")
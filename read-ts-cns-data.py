@@ -23,261 +23,151 @@ Prerequisiti di sistema:
 Utilizzo:
     python read-ts-cns-data.py         # Esecuzione normale
     python read-ts-cns-data.py --debug # Modalità debug con informazioni dettagliate
+    python read-ts-cns-data.py --all-readers # Legge in parallelo le carte di tutti i lettori
+    python read-ts-cns-data.py --record lettura.trace # Registra il traffico APDU della lettura
+    python read-ts-cns-data.py --replay lettura.trace # Ripete la lettura dalla traccia, senza carta
+    python read-ts-cns-data.py --watch [--output letture.jsonl] # Un oggetto JSON per lettura (JSON Lines)
+    python read-ts-cns-data.py --serve # Connessione persistente: una lettura per ogni riga su stdin
 
 Autore: Antonio Musarra <antonio.musarra[at]gmail.com>
 """
 
 import argparse
-import array
+import json
+import queue
+import sys
+import time
+from datetime import datetime, timezone
 from smartcard.System import readers
 from smartcard.util import toHexString
-from colorama import Fore, Style, init
-
-# Inizializza colorama per la colorazione del testo nel terminale
-init(autoreset=True)
+from colorama import init
+from modules.TSCNSCard import NoSmartCardReaderFound, NoSmartCardInserted, set_debug, set_messages, debug_msg, \
+    success_msg, error_msg, get_ts_data, get_apdu_stats, dump_raw_data
+from modules.CardSession import CardSessionManager, MultiReaderWatcher
+from modules.CardDataCache import CardDataCache
+from modules.APDUTrace import APDUTrace, RecordingConnection, ReplayConnection
 
 # Parsiamo gli argomenti
 parser = argparse.ArgumentParser(description='Legge i dati personali da una TS-CNS.')
 parser.add_argument('--debug', action='store_true', help='Abilita la modalità debug')
+parser.add_argument('--all-readers', action='store_true',
+                    help='Osserva tutti i lettori e legge in parallelo le carte inserite (Ctrl+C per uscire)')
+parser.add_argument('--record', metavar='FILE', help='Salva in FILE la traccia degli APDU scambiati con la carta')
+parser.add_argument('--replay', metavar='FILE', help='Legge i dati dalla traccia FILE invece che dalla carta')
+parser.add_argument('--watch', action='store_true',
+                    help='Resta in ascolto su tutti i lettori e scrive un oggetto JSON per ogni lettura o rimozione')
+parser.add_argument('--output', metavar='FILE', help='Con --watch, accoda gli oggetti JSON a FILE invece che a stdout')
+parser.add_argument('--serve', action='store_true',
+                    help='Tiene aperta la connessione alla carta e legge i dati a ogni riga ricevuta su stdin')
 args = parser.parse_args()
+set_debug(args.debug)
 
-
-# Definizione delle eccezioni personalizzate
-class NoSmartCardReaderFound(Exception):
-    pass
-
-
-class NoSmartCardInserted(Exception):
-    pass
-
-
-# Funzione per stampare messaggi di debug
-def debug_msg(message):
-    global args
-    if args.debug:
-        print(f"{Fore.YELLOW}🐞🛠️ {message}")
+if args.watch:
+    # stdout è riservato ai dati JSON: i messaggi vanno su stderr, senza colori
+    set_messages(sys.stderr, colors=False)
+else:
+    # Inizializza colorama per la colorazione del testo nel terminale
+    init(autoreset=True)
 
 
-# Funzione per stampare messaggi di successo
-def success_msg(message):
-    print(f"{Fore.GREEN}✅ {message}")
-
-# Funzione per stampare errori
-def warn_msg(message):
-    print(f"{Fore.YELLOW}⚠️ {message}")
-
-
-# Funzione per stampare errori
-def error_msg(message):
-    print(f"{Fore.RED}❌ {message}")
-
-
-def send_apdu(connection, apdu):
-    """Invia un comando APDU alla Smart Card e riceve la risposta."""
-    debug_msg(f"Inviando APDU: {apdu}")
+def print_ts_data(ts_data, tag=""):
+    """Stampa i dati letti; tag (es. "[lettore] ") distingue le righe dei diversi lettori."""
+    if ts_data:
+        debug_msg(f"{tag}Dati letti dalla Smart Card:")
 
+        # Mostra dump completo in modalità debug
+        if args.debug:
+            dump_raw_data(ts_data['raw_data'])
+
+        # Mostra dati decodificati
+        if ts_data['decoded_data']:
+            success_msg(f"{tag}Dati decodificati:")
+            for field, value in ts_data['decoded_data'].items():
+                field_name = field.replace('_', ' ').capitalize()
+                print(f"{tag}  {field_name}: {value}")
+        else:
+            error_msg(f"{tag}Non è stato possibile decodificare i dati")
+
+
+def watch_all_readers():
+    """Legge in parallelo le carte inserite in tutti i lettori, un worker per lettore."""
+    # I worker accodano i risultati: li stampa solo questo thread, così le righe non si mescolano
+    results = queue.Queue()
+    watcher = MultiReaderWatcher(lambda reader, ts_data, error: results.put((reader, ts_data, error)))
+    watcher.start()
+    success_msg("In attesa delle smart card su tutti i lettori (Ctrl+C per uscire)")
     try:
-        response, sw1, sw2 = connection.transmit(apdu)
-        status_str = f"SW1={sw1:02X}, SW2={sw2:02X}"
-        debug_msg(f"Risposta: {toHexString(response)} {status_str}")
-        return response, sw1, sw2
-    except Exception as e:
-        error_msg(f"Errore nell'invio dell'APDU: {e}")
-        return [], 0, 0
-
-
-def hex_to_string(hex_data):
-    """Converte dati esadecimali in una stringa."""
-    result = ""
-    for i in range(0, len(hex_data), 2):
-        if i + 1 < len(hex_data):
-            # Prende due caratteri esadecimali e li converte in un carattere
-            char_code = int(hex_data[i:i + 2], 16)
-            # Verifica se il carattere è un ASCII stampabile
-            if 32 <= char_code <= 126:
-                result += chr(char_code)
+        while True:
+            try:
+                # Attesa a tempo: così Ctrl+C viene gestito anche se nessuna carta viene letta
+                (reader, ts_data, error) = results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            tag = f"[{reader}] "
+            if error is not None:
+                error_msg(f"{tag}Errore durante la lettura: {error}")
+            elif ts_data is None:
+                error_msg(f"{tag}Impossibile leggere i dati personali")
             else:
-                result += '.'
-    return result
-
-
-def get_ts_data(connection, debug=False):
-    """Legge i dati personali dalla TS-CNS."""
-    # Comandi APDU
-    SELECT_MF = [0x00, 0xA4, 0x00, 0x00, 0x02, 0x3F, 0x00]
-    SELECT_DF1 = [0x00, 0xA4, 0x00, 0x00, 0x02, 0x11, 0x00]
-    SELECT_EF_PERS = [0x00, 0xA4, 0x00, 0x00, 0x02, 0x11, 0x02]
-    READ_BIN = [0x00, 0xB0, 0x00, 0x00, 0x00]
-
-    # Seleziona il Master File (MF)
-    response, sw1, sw2 = send_apdu(connection, SELECT_MF)
-    if sw1 != 0x90 or sw2 != 0x00:
-        error_msg(f"Errore durante la selezione del Master File: SW1={sw1:02X}, SW2={sw2:02X}")
-        return None
-
-    debug_msg("MF selezionato con successo")
-
-    # Seleziona il Dedicated File (DF)
-    response, sw1, sw2 = send_apdu(connection, SELECT_DF1)
-    if sw1 != 0x90 or sw2 != 0x00:
-        error_msg(f"Errore durante la selezione del DF: SW1={sw1:02X}, SW2={sw2:02X}")
-        return None
-
-    debug_msg("DF selezionato con successo")
-
-    # Seleziona l'Elementary File (EF) contenente i dati personali
-    response, sw1, sw2 = send_apdu(connection, SELECT_EF_PERS)
-    if sw1 != 0x90 or sw2 != 0x00:
-        error_msg(f"Errore durante la selezione dell'EF: SW1={sw1:02X}, SW2={sw2:02X}")
-        return None
-
-    debug_msg("EF selezionato con successo")
-
-    # Leggi i dati binari dal file selezionato
-    response, sw1, sw2 = send_apdu(connection, READ_BIN)
-
-    if sw1 == 0x6C:  # Se la lunghezza è errata, riprova con la lunghezza corretta
-        read_bin_with_length = [0x00, 0xB0, 0x00, 0x00, sw2]
-        warn_msg(f"Riprovo con READ_BIN e lunghezza corretta: {read_bin_with_length}")
-        response, sw1, sw2 = send_apdu(connection, read_bin_with_length)
-
-    # Puoi anche aggiungere un controllo per il codice errore 67:00
-    if sw1 == 0x67 and sw2 == 0x00:
-        warn_msg("Errore 67:00 - Provo a leggere con lunghezza standard")
-        # Prova con una lunghezza standard (ad esempio 0xFF o 0x80)
-        read_bin_with_length = [0x00, 0xB0, 0x00, 0x00, 0xFF]
-        response, sw1, sw2 = send_apdu(connection, read_bin_with_length)
-
-    if sw1 != 0x90 or sw2 != 0x00:
-        error_msg(f"Errore durante la lettura dei dati: SW1={sw1:02X}, SW2={sw2:02X}")
-        return None
-
-    debug_msg("Dati letti con successo")
-
-    # Elabora e restituisci i dati letti
-    hex_data = ''.join([f'{b:02X}' for b in response])
-
-    # Aggiungi la decodifica
-    decoded_data = decode_ts_data(response)
-
-    return {
-        'raw_data': response,
-        'hex_data': hex_data,
-        'string_data': hex_to_string(hex_data),
-        'decoded_data': decoded_data
-    }
-
+                print_ts_data(ts_data, tag)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.stop()
+
+
+def timed_read(connection):
+    """Lettura per --watch: restituisce i dati insieme all'ATR e alla latenza della lettura."""
+    start = time.monotonic()
+    ts_data = get_ts_data(connection)
+    return {'ts_data': ts_data, 'atr': toHexString(connection.getATR()), 'latency': time.monotonic() - start}
+
+
+def watch_json():
+    """Scrive un oggetto JSON per riga per ogni lettura o rimozione di una carta, su tutti i lettori."""
+    if args.output:
+        output = open(args.output, 'a', buffering=1, encoding='utf-8')
+    else:
+        output = sys.stdout
+        output.reconfigure(line_buffering=True)
+
+    events = queue.Queue()
+
+    def now():
+        return datetime.now(timezone.utc).isoformat()
+
+    def read_done(reader, result, error):
+        event = {'event': 'read', 'reader': reader, 'timestamp': now()}
+        if error is not None:
+            event['error'] = str(error)
+        else:
+            ts_data = result['ts_data']
+            event['atr'] = result['atr']
+            event['latency_ms'] = round(result['latency'] * 1000, 1)
+            if ts_data is None or ts_data['decoded_data'] is None:
+                event['error'] = "Impossibile leggere i dati personali"
+            else:
+                event['fields'] = ts_data['decoded_data']
+        events.put(event)
 
-def decode_ts_data(raw_data):
-    """Decodifica i dati personali dalla TS-CNS interpretando i prefissi di lunghezza."""
+    watcher = MultiReaderWatcher(read_done, read=timed_read, removed=lambda reader: events.put(
+        {'event': 'removed', 'reader': reader, 'timestamp': now()}))
+    watcher.start()
+    debug_msg("In attesa delle smart card su tutti i lettori (Ctrl+C per uscire)")
     try:
-        # Converti i dati raw in un array di byte
-        dati_bytes = array.array('B', raw_data).tobytes()
-        dati_ts = {}
-
-        # Salta i primi 6 byte (dimensione)
-        pos = 6
-
-        # Leggi ogni campo con il suo prefisso di lunghezza
-        # Emettitore
-        field_len = int(dati_bytes[pos:pos + 2], 16)
-        pos += 2
-        if field_len > 0:
-            dati_ts['emettitore'] = dati_bytes[pos:pos + field_len].decode('ascii')
-        pos += field_len
-
-        # Data rilascio
-        field_len = int(dati_bytes[pos:pos + 2], 16)
-        pos += 2
-        if field_len > 0:
-            data = dati_bytes[pos:pos + field_len].decode('ascii')
-            dati_ts['data_emissione'] = f"{data[0:2]}/{data[2:4]}/{data[4:8]}"
-        pos += field_len
-
-        # Data scadenza
-        field_len = int(dati_bytes[pos:pos + 2], 16)
-        pos += 2
-        if field_len > 0:
-            data = dati_bytes[pos:pos + field_len].decode('ascii')
-            dati_ts['data_scadenza'] = f"{data[0:2]}/{data[2:4]}/{data[4:8]}"
-        pos += field_len
-
-        # Cognome
-        field_len = int(dati_bytes[pos:pos + 2], 16)
-        pos += 2
-        if field_len > 0:
-            dati_ts['cognome'] = dati_bytes[pos:pos + field_len].decode('ascii')
-        pos += field_len
-
-        # Nome
-        field_len = int(dati_bytes[pos:pos + 2], 16)
-        pos += 2
-        if field_len > 0:
-            dati_ts['nome'] = dati_bytes[pos:pos + field_len].decode('ascii')
-        pos += field_len
-
-        # Data nascita
-        field_len = int(dati_bytes[pos:pos + 2], 16)
-        pos += 2
-        if field_len > 0:
-            data = dati_bytes[pos:pos + field_len].decode('ascii')
-            dati_ts['data_nascita'] = f"{data[0:2]}/{data[2:4]}/{data[4:8]}"
-        pos += field_len
-
-        # Sesso
-        field_len = int(dati_bytes[pos:pos + 2], 16)
-        pos += 2
-        if field_len > 0:
-            dati_ts['sesso'] = dati_bytes[pos:pos + field_len].decode('ascii')
-        pos += field_len
-
-        # Statura (potrebbe essere vuota)
-        field_len = int(dati_bytes[pos:pos + 2], 16)
-        pos += 2
-        if field_len > 0:
-            dati_ts['statura'] = dati_bytes[pos:pos + field_len].decode('ascii')
-        pos += field_len
-
-        # Codice fiscale
-        field_len = int(dati_bytes[pos:pos + 2], 16)
-        pos += 2
-        if field_len > 0:
-            dati_ts['codice_fiscale'] = dati_bytes[pos:pos + field_len].decode('ascii')
-        pos += field_len
-
-        # Cittadinanza
-        field_len = int(dati_bytes[pos:pos + 2], 16)
-        pos += 2
-        if field_len > 0:
-            dati_ts['cittadinanza'] = dati_bytes[pos:pos + field_len].decode('ascii')
-        pos += field_len
-
-        # Comune nascita
-        field_len = int(dati_bytes[pos:pos + 2], 16)
-        pos += 2
-        if field_len > 0:
-            dati_ts['comune_nascita'] = dati_bytes[pos:pos + field_len].decode('ascii')
-        pos += field_len
-
-        return dati_ts
-
-    except Exception as e:
-        error_msg(f"Errore durante la decodifica: {e}")
-        if args.debug:
-            import traceback
-            traceback.print_exc()
-        return None
-
-
-def dump_raw_data(raw_data):
-    """Mostra una rappresentazione dettagliata dei dati grezzi per analisi."""
-    ascii_dump = ''.join([chr(b) if 32 <= b <= 126 else '.' for b in raw_data])
-
-    debug_msg("Esadecimale:")
-    # Mostra 16 byte per riga
-    for i in range(0, len(raw_data), 16):
-        hex_line = ' '.join([f'{raw_data[j]:02X}' for j in range(i, min(i + 16, len(raw_data)))])
-        debug_msg(f"{i:04X}: {hex_line:48s}  {ascii_dump[i:i + 16]}")
+        # Un solo thread scrive, così ogni oggetto resta su una riga intera
+        while True:
+            try:
+                event = events.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            output.write(json.dumps(event, ensure_ascii=False) + '\n')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.stop()
+        if output is not sys.stdout:
+            output.close()
 
 
 def main():
@@ -297,6 +187,8 @@ def main():
     # Crea una connessione con la smart card
     try:
         connection = reader.createConnection()
+        if args.record:
+            connection = RecordingConnection(connection)
         connection.connect()
         if args.debug:
             debug_msg("Connessione alla smart card stabilita")
@@ -310,22 +202,9 @@ def main():
     try:
         # Leggi i dati personali dalla TS-CNS
         ts_data = get_ts_data(connection, args.debug)
+        debug_msg(f"Scambi APDU: {get_apdu_stats()}")
 
-        if ts_data:
-            debug_msg("Dati letti dalla Smart Card:")
-
-            # Mostra dump completo in modalità debug
-            if args.debug:
-                dump_raw_data(ts_data['raw_data'])
-
-            # Mostra dati decodificati
-            if ts_data['decoded_data']:
-                success_msg("Dati decodificati:")
-                for field, value in ts_data['decoded_data'].items():
-                    field_name = field.replace('_', ' ').capitalize()
-                    print(f"  {field_name}: {value}")
-            else:
-                error_msg("Non è stato possibile decodificare i dati")
+        print_ts_data(ts_data)
     finally:
         # Disconnetti dalla smart card
         try:
@@ -335,7 +214,67 @@ def main():
         except Exception as e:
             if args.debug:
                 error_msg(f"Errore durante la disconnessione: {e}")
+        if args.record:
+            connection.trace.save(args.record)
+            success_msg(f"Traccia di {len(connection.trace)} APDU salvata in {args.record}")
+
+
+def serve():
+    """Servizio di lunga durata: lettori e connessione restano aperti tra una lettura e l'altra.
+
+    Ogni riga ricevuta su stdin richiede una lettura: vuota per il primo lettore, altrimenti
+    con il nome del lettore. Finché la carta resta inserita una lettura costa solo gli APDU, e
+    la cache evita di rileggere i dati personali della stessa carta."""
+    cache = CardDataCache()
+    sessions = CardSessionManager(cache=cache)
+    success_msg("Invio per leggere la carta (oppure il nome del lettore), Ctrl+D per uscire")
+    try:
+        for line in sys.stdin:
+            reader = line.strip() or None
+            start = time.monotonic()
+            try:
+                ts_data = sessions.read_personal_data(reader)
+            except (NoSmartCardReaderFound, NoSmartCardInserted) as e:
+                error_msg(str(e))
+                continue
+            except Exception as e:
+                # Carta rimossa durante la lettura: la prossima richiesta si riconnette
+                error_msg(f"Errore durante la lettura: {e}")
+                try:
+                    sessions.reset(reader)
+                except NoSmartCardReaderFound:
+                    pass
+                continue
+            debug_msg(f"Lettura completata in {(time.monotonic() - start) * 1000:.1f} ms")
+            if ts_data is None:
+                error_msg("Impossibile leggere i dati personali")
+            else:
+                print_ts_data(ts_data)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sessions.close()
+        debug_msg(f"Cache dei dati personali: {cache.stats()}")
+
+
+def replay():
+    """Ripete la lettura servendo a get_ts_data le risposte registrate con --record."""
+    trace = APDUTrace.load(args.replay)
+    debug_msg(f"ATR registrato: {toHexString(trace.atr)}")
+    connection = ReplayConnection(trace)
+    print_ts_data(get_ts_data(connection, args.debug))
+    if not connection.finished():
+        error_msg(f"Riprodotti {connection.position} APDU su {len(trace)} registrati")
 
 
 if __name__ == "__main__":
-    main()
+    if args.replay:
+        replay()
+    elif args.watch:
+        watch_json()
+    elif args.serve:
+        serve()
+    elif args.all_readers:
+        watch_all_readers()
+    else:
+        main()
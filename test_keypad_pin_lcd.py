@@ -79,8 +79,8 @@ correct_pin = "1234"
 def cleanup():
     global keypad
 
-    lcd.clear()
-    lcd.message("Goodbye...\n")
+    lcd.showScreen("goodbye")
+    lcd.stopRenderer()
     lcd.backlight = False
     keypad.cleanup()
 
@@ -98,9 +98,7 @@ def check_pin(key):
 
 # Display info on corrected PIN code and exit
 def correct_pin_entered():
-    lcd.clear()
-    lcd.message("Access granted\n")
-    lcd.message("Accepted PIN\n")
+    lcd.showScreen("granted")
 
     print("PIN accepted. Access granted.")
 
@@ -116,18 +114,14 @@ def digit_entered(key):
     entered_pin += str(key)
     print(entered_pin)
 
-    lcd.clear()
-    lcd.message("PIN: " + entered_pin + "\n")
-    lcd.message("# to confirm")
+    lcd.post("PIN: " + entered_pin + "\n# to confirm")
 
     check_pin(key)
 
 
 # Display info on in-corrected PIN code and exit
 def incorrect_pin_entered():
-    lcd.clear()
-    lcd.message("Access denied\n")
-    lcd.message("Incorrect PIN\n")
+    lcd.showScreen("denied")
 
     print("Incorrect PIN. Access denied.")
 
@@ -141,8 +135,15 @@ def initialize_lcd():
     mcp.output(3, 1)  # turn on LCD backlight
     lcd.begin(16, 2)  # set number of LCD lines and columns
 
-    lcd.message("Enter your PIN\n")
-    lcd.message("Press * to clear")
+    # Static screens are compiled once and replayed as raw expander bytes
+    lcd.defineScreen("welcome", "Enter your PIN\nPress * to clear")
+    lcd.defineScreen("granted", "Access granted\nAccepted PIN")
+    lcd.defineScreen("denied", "Access denied\nIncorrect PIN")
+    lcd.defineScreen("goodbye", "Goodbye...")
+
+    lcd.startRenderer()  # draw from a background thread, key handlers never wait for the bus
+
+    lcd.showScreen("welcome")
 
 
 # Manage no PIN code key
@@ -152,9 +153,7 @@ def non_digit_entered(key):
     if key == "*" and len(entered_pin) > 0:
         entered_pin = entered_pin[:-1]
 
-        lcd.clear()
-        lcd.message("PIN: " + entered_pin + "\n")
-        lcd.message("# to confirm")
+        lcd.post("PIN: " + entered_pin + "\n# to confirm")
 
         print(entered_pin)
 
@@ -40,10 +40,10 @@ __status__ = "Development"
 from pad4pi import rpi_gpio
 from modules.PCF8574 import PCF8574_GPIO
 from modules.Adafruit_LCD1602 import Adafruit_CharLCD
+from modules.PKCS11PinVerifier import PKCS11PinVerifier, PinVerificationError
 
 import time
 import sys
-import subprocess
 
 # Check I2C address via command i2cdetect -y 1
 PCF8574_address = 0x27  # I2C address of the PCF8574 chip.
@@ -62,6 +62,13 @@ except:
 # Create LCD, passing in MCP GPIO adapter.
 lcd = Adafruit_CharLCD(pin_rs=0, pin_e=2, pins_db=[4, 5, 6, 7], GPIO=mcp)
 
+# Load the PKCS#11 module once: every PIN check is then a C_Login/C_Logout on the card.
+try:
+    pin_verifier = PKCS11PinVerifier()
+except PinVerificationError as e:
+    print("PKCS#11 Error: ", e)
+    exit(1)
+
 KEYPAD = [
     [1, 2, 3, "A"],
     [4, 5, 6, "B"],
@@ -78,9 +85,10 @@ entered_pin = ""
 def cleanup():
     global keypad
 
-    lcd.clear()
-    lcd.message("Goodbye...\n")
+    lcd.showScreen("goodbye")
+    lcd.stopRenderer()
     lcd.backlight = False
+    pin_verifier.close()
     keypad.cleanup()
 
 
@@ -88,16 +96,14 @@ def cleanup():
 def check_pin(key):
     global entered_pin
 
-    command_to_check_pin_cns = "pkcs11-tool --login --test --verbose --pin " + entered_pin
-
     if len(entered_pin) >= 8 or key == "#":
-        p = subprocess.Popen(command_to_check_pin_cns, shell=True, stdout=subprocess.PIPE)
-        (output, err) = p.communicate()
-        p_status = p.wait()
-
-        print("Check PIN: ", output)
+        try:
+            pin_is_ok = pin_verifier.verify(entered_pin)
+        except PinVerificationError as e:
+            print("Check PIN: ", e)
+            pin_is_ok = False
 
-        if p_status == 0:
+        if pin_is_ok:
             correct_pin_entered()
         else:
             incorrect_pin_entered()
@@ -105,9 +111,7 @@ def check_pin(key):
 
 # Display info on corrected PIN code and exit
 def correct_pin_entered():
-    lcd.clear()
-    lcd.message("Access granted\n")
-    lcd.message("Accepted PIN\n")
+    lcd.showScreen("granted")
 
     print("PIN accepted. Access granted.")
 
@@ -123,18 +127,14 @@ def digit_entered(key):
     entered_pin += str(key)
     print(entered_pin)
 
-    lcd.clear()
-    lcd.message("PIN: " + entered_pin + "\n")
-    lcd.message("# to confirm")
+    lcd.post("PIN: " + entered_pin + "\n# to confirm")
 
     check_pin(key)
 
 
 # Display info on in-corrected PIN code and exit
 def incorrect_pin_entered():
-    lcd.clear()
-    lcd.message("Access denied\n")
-    lcd.message("Incorrect PIN\n")
+    lcd.showScreen("denied")
 
     print("Incorrect PIN. Access denied.")
 
@@ -148,8 +148,15 @@ def initialize_lcd():
     mcp.output(3, 1)  # turn on LCD backlight
     lcd.begin(16, 2)  # set number of LCD lines and columns
 
-    lcd.message("Enter your PIN\n")
-    lcd.message("Press * to clear")
+    # Static screens are compiled once and replayed as raw expander bytes
+    lcd.defineScreen("welcome", "Enter your PIN\nPress * to clear")
+    lcd.defineScreen("granted", "Access granted\nAccepted PIN")
+    lcd.defineScreen("denied", "Access denied\nIncorrect PIN")
+    lcd.defineScreen("goodbye", "Goodbye...")
+
+    lcd.startRenderer()  # draw from a background thread, key handlers never wait for the bus
+
+    lcd.showScreen("welcome")
 
 
 # Manage no PIN code key
@@ -159,9 +166,7 @@ def non_digit_entered(key):
     if key == "*" and len(entered_pin) > 0:
         entered_pin = entered_pin[:-1]
 
-        lcd.clear()
-        lcd.message("PIN: " + entered_pin + "\n")
-        lcd.message("# to confirm")
+        lcd.post("PIN: " + entered_pin + "\n# to confirm")
 
         print(entered_pin)
 
@@ -186,6 +191,11 @@ try:
 
     initialize_lcd()
 
+    try:
+        pin_verifier.open()  # session ready before the first PIN is typed
+    except PinVerificationError:
+        pass  # no card yet: the session is opened by the first check
+
     print("Enter your PIN:")
     print("Press * to clear previous digit.")
     print("Press # to confirm.")